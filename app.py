@@ -1,5 +1,6 @@
 import os
 import logging
+import tempfile
 from flask import Flask, flash
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
@@ -31,17 +32,39 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # Configure upload paths
 app.config["UPLOAD_FOLDER"] = os.environ.get("UPLOAD_FOLDER", os.path.join(os.getcwd(), "uploads"))
+app.config["SCRATCH_FOLDER"] = os.environ.get("SCRATCH_FOLDER") or os.path.join(tempfile.gettempdir(), "videoshare-scratch")  # Where jobs encode before publishing (local SSD/tmpfs when UPLOAD_FOLDER is a NAS)
 app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_CONTENT_LENGTH", 1024 * 1024 * 1024))  # Default: 1GB max upload size
+app.config["UPLOAD_SESSION_TTL"] = int(os.environ.get("UPLOAD_SESSION_TTL", 86400))  # Seconds an unfinished resumable upload is kept without new chunks, 0 = forever
 app.config["ALLOWED_EXTENSIONS"] = {"mp4", "mov", "avi", "mkv", "webm", "flv", "wmv"}
 
 # Video processing configuration
 app.config["MAX_VIDEOS_PER_USER"] = int(os.environ.get("MAX_VIDEOS_PER_USER", 50))
 app.config["CONCURRENT_PROCESSING"] = int(os.environ.get("CONCURRENT_PROCESSING", 1))
+app.config["DOWNLOAD_CONCURRENCY"] = int(os.environ.get("DOWNLOAD_CONCURRENCY", 2))  # Link downloads running at once per processing process
+app.config["PROCESSOR_ENABLED"] = os.environ.get("PROCESSOR_ENABLED", "true").lower() in ("1", "true", "yes")  # Run processing workers inside web processes (false = leave the queue to worker.py)
+app.config["PROCESSING_LEASE_SECONDS"] = int(os.environ.get("PROCESSING_LEASE_SECONDS", 120))  # How long a claimed job is reserved without a heartbeat
+app.config["PROCESSING_MAX_ATTEMPTS"] = int(os.environ.get("PROCESSING_MAX_ATTEMPTS", 5))  # Attempts before an interrupted or transiently failing job is marked failed
+app.config["RETRY_BASE_DELAY"] = int(os.environ.get("RETRY_BASE_DELAY", 30))  # First retry backoff in seconds, doubled on every attempt
+app.config["RETRY_MAX_DELAY"] = int(os.environ.get("RETRY_MAX_DELAY", 3600))  # Longest retry backoff in seconds
+app.config["QUEUE_POLL_INTERVAL"] = int(os.environ.get("QUEUE_POLL_INTERVAL", 60))  # Fallback queue poll when no wakeup arrives (seconds)
+app.config["REMUX_MAX_BITRATE"] = int(os.environ.get("REMUX_MAX_BITRATE", 20000000))  # Re-encode H.264 sources above this bitrate (bits/s, 0 = no limit)
+app.config["HLS_RENDITIONS"] = [int(height) for height in os.environ.get("HLS_RENDITIONS", "1080,720,480,360").split(",") if height.strip()]  # HLS ladder heights (short side), below the source-resolution top rendition
+app.config["CHUNKED_ENCODING_MIN_DURATION"] = int(os.environ.get("CHUNKED_ENCODING_MIN_DURATION", 600))  # Encode sources at least this long (seconds) in parallel chunks, 0 = never
+app.config["CHUNK_DURATION"] = int(os.environ.get("CHUNK_DURATION", 60))  # Target chunk length in seconds, cut at the next keyframe
+app.config["CHUNK_WORKERS"] = int(os.environ.get("CHUNK_WORKERS", 0))  # Chunks encoded at once per video, 0 = as many as the job's thread budget covers at a thread per rendition
+app.config["PROCESSING_TIMEOUT_SCALE"] = float(os.environ.get("PROCESSING_TIMEOUT_SCALE", 1.0))  # Multiplier for the ffmpeg/yt-dlp per-stage time budgets
+app.config["FFMPEG_THREADS"] = int(os.environ.get("FFMPEG_THREADS", 0))  # Encoder threads per job, 0 = available cores divided by the worker concurrency
+app.config["PROCESSING_NICE"] = int(os.environ.get("PROCESSING_NICE", 10))  # nice level for ffmpeg processes, 0 = normal priority
+app.config["PROCESSING_IONICE_CLASS"] = os.environ.get("PROCESSING_IONICE_CLASS", "")  # ionice class for ffmpeg processes: idle, best-effort or realtime (empty = unchanged)
+app.config["PROCESSING_CGROUP"] = os.environ.get("PROCESSING_CGROUP", "")  # Delegated cgroup v2 directory to run ffmpeg processes in (empty = none)
+app.config["PROCESSING_CPU_QUOTA"] = float(os.environ.get("PROCESSING_CPU_QUOTA", 0))  # CPU cores all ffmpeg processes in PROCESSING_CGROUP may use together, 0 = no quota
 
 # yt-dlp configuration
 app.config["YT_DLP_PROXY"] = os.environ.get("YT_DLP_PROXY", "")
 app.config["YT_DLP_RATE_LIMIT"] = os.environ.get("YT_DLP_RATE_LIMIT", "")
 app.config["YT_DLP_MAX_DURATION"] = int(os.environ.get("YT_DLP_MAX_DURATION", 3600))  # 1 hour default
+app.config["YT_DLP_ENGINE"] = os.environ.get("YT_DLP_ENGINE", "subprocess")  # subprocess (a yt-dlp process per step) or python (in-process YoutubeDL)
+app.config["METADATA_CACHE_TTL"] = int(os.environ.get("METADATA_CACHE_TTL", 900))  # Seconds extracted link metadata is reused for the same URL, 0 = no cache
 
 # Ensure upload directory exists with proper permissions
 upload_base = app.config["UPLOAD_FOLDER"]
@@ -112,9 +135,10 @@ with app.app_context():
     from routes import register_routes
     register_routes(app)
     
-    # Import and start background processing
-    from video_processor import init_processor
-    init_processor()
+    # Import and start background processing, unless dedicated workers (worker.py) drain the queue
+    if app.config["PROCESSOR_ENABLED"]:
+        from video_processor import init_processor
+        init_processor()
 
 # Add context processor for global template variables
 @app.context_processor
@@ -1,138 +1,283 @@
 import os
-import threading
+import sys
+import copy
 import logging
 import subprocess
 import json
 import re
 import shutil
 import time
+import tempfile
+import zipfile
+import importlib
+import threading
 import requests
-from urllib.parse import urlparse, urljoin
+from sqlalchemy.orm.exc import StaleDataError
+from urllib.parse import urlparse, urljoin, urlunparse, urlencode, parse_qsl
 from app import db
-from models import Video, ProcessingQueue
+from models import Video
+from process_runner import (job_scope, run_process, stage_timeout, current_video_id, raise_if_cancelled,
+                            JobCancelled, TransientError, is_transient_error)
 
-# Configure yt-dlp path with enhanced debugging
-def get_yt_dlp_path():
-    """Get the path to yt-dlp executable, trying multiple options with detailed debugging"""
+# Setup logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Where yt-dlp may be installed, checked in order before falling back to PATH
+YT_DLP_LOCATIONS = [
+    # Docker container paths
+    '/app/bin/yt-dlp',
+    '/app/bin/yt-dlp-wrapper',
+    '/usr/local/bin/yt-dlp',
+    '/usr/local/bin/yt-dlp-wrapper',
+    '/usr/bin/yt-dlp',
     
-    # Print current working directory for debugging
-    cwd = os.getcwd()
-    logging.info(f"Current working directory: {cwd}")
+    # Dockge specific paths
+    '/opt/stacks/nickclips/bin/yt-dlp',
     
-    # Print environment PATH for debugging
-    env_path = os.environ.get('PATH', '')
-    logging.info(f"Environment PATH: {env_path}")
+    # Local development paths, including the emergency install below
+    os.path.join(os.getcwd(), 'bin', 'yt-dlp'),
+    os.path.join(os.getcwd(), 'bin', 'yt-dlp-wrapper'),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'yt-dlp'),
+    os.path.join(os.getcwd(), 'bin', 'yt-dlp-emergency'),
+]
+
+# The resolved yt-dlp executable and its --version output, probed once per process
+yt_dlp_executable = None
+yt_dlp_version = None
+yt_dlp_lock = threading.Lock()
+
+# The yt_dlp module used by the in-process engine, imported on first use (False = unavailable)
+yt_dlp_module = None
+
+# Hosts that serve the same videos under another name, mapped to the canonical one
+URL_HOST_ALIASES = {
+    'youtube.com': 'www.youtube.com',
+    'm.youtube.com': 'www.youtube.com',
+    'x.com': 'twitter.com',
+    'www.x.com': 'twitter.com',
+    'mobile.x.com': 'twitter.com',
+    'www.twitter.com': 'twitter.com',
+    'mobile.twitter.com': 'twitter.com',
+    'reddit.com': 'www.reddit.com',
+    'old.reddit.com': 'www.reddit.com',
+    'new.reddit.com': 'www.reddit.com',
+    'np.reddit.com': 'www.reddit.com',
+    'm.reddit.com': 'www.reddit.com',
+}
+
+# Query parameters that only record where a link was shared from (plus any utm_*)
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'igshid', 'mc_cid', 'mc_eid'}
+SITE_TRACKING_PARAMS = {
+    'youtube.com': {'si', 'feature', 'pp', 't'},
+    'twitter.com': {'s', 't', 'ref_src', 'ref_url'},
+    'reddit.com': {'share_id', 'rdt', 'context', 'ref', 'ref_source'},
+}
+
+# Extracted link metadata by canonical URL: (expires at, info summary, info JSON or None)
+metadata_cache = {}
+metadata_cache_lock = threading.Lock()
+METADATA_CACHE_SIZE = 256
+
+def find_yt_dlp():
+    """Return the first executable yt-dlp in YT_DLP_LOCATIONS or on PATH, or None"""
+    for location in YT_DLP_LOCATIONS:
+        if os.path.isfile(location) and os.access(location, os.X_OK):
+            return location
+    return shutil.which('yt-dlp')
+
+def resolve_yt_dlp():
+    """Return (path, version) of the yt-dlp executable, or (None, None) if it isn't installed
     
-    # Explicitly check if Python can execute commands
-    try:
-        # Try a simple command to check subprocess functionality
-        test_result = subprocess.run(['echo', 'Testing subprocess'], 
-                                     capture_output=True, text=True)
-        logging.info(f"Subprocess test: {test_result.stdout.strip()}")
-    except Exception as e:
-        logging.error(f"Subprocess test failed: {str(e)}")
-    
-    # Common locations to check for yt-dlp - add more Dockge-specific paths
-    locations = [
-        # Docker container paths
-        '/app/bin/yt-dlp',
-        '/app/bin/yt-dlp-wrapper',
-        '/usr/local/bin/yt-dlp',
-        '/usr/local/bin/yt-dlp-wrapper',
-        
-        # Dockge specific paths
-        '/opt/stacks/nickclips/bin/yt-dlp',
-        '/opt/stacks/*/bin/yt-dlp',  # Try with wildcard for different stack names
-        '/opt/*/bin/yt-dlp',
-        
-        # Local development paths
-        os.path.join(cwd, 'bin', 'yt-dlp'),
-        os.path.join(cwd, 'bin', 'yt-dlp-wrapper'),
-        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'yt-dlp'),
-    ]
-    
-    # Check each location with detailed logging
-    for location in locations:
-        # Skip paths with wildcards as os.path cannot handle them directly
-        if '*' in location:
-            logging.info(f"Skipping wildcard path check (would need glob): {location}")
-            continue
-            
-        logging.info(f"Checking location: {location}")
-        if os.path.exists(location):
-            logging.info(f"  - File exists at: {location}")
-            if os.path.isfile(location):
-                logging.info(f"  - It's a file")
-                if os.access(location, os.X_OK):
-                    logging.info(f"  - And it's executable")
-                    return location
-                else:
-                    logging.warning(f"  - But it's not executable")
+    The locations are probed on first use and again only when the cached
+    binary has disappeared (e.g. it was reinstalled somewhere else).
+    """
+    global yt_dlp_executable, yt_dlp_version
+    
+    with yt_dlp_lock:
+        if yt_dlp_executable and os.path.isfile(yt_dlp_executable):
+            return yt_dlp_executable, yt_dlp_version
+        
+        if yt_dlp_executable:
+            logger.warning(f"yt-dlp disappeared from {yt_dlp_executable}, probing again")
+        yt_dlp_executable = find_yt_dlp()
+        yt_dlp_version = None
+        if not yt_dlp_executable:
+            logger.error("yt-dlp executable not found in any location")
+            return None, None
+        
+        try:
+            result = subprocess.run([yt_dlp_executable, '--version'], capture_output=True, text=True, timeout=30)
+            if result.returncode == 0:
+                yt_dlp_version = result.stdout.strip()
             else:
-                logging.warning(f"  - But it's not a file (might be a directory)")
-        else:
-            logging.warning(f"  - File does not exist")
-    
-    # Try system path via shutil.which with detailed logging
-    logging.info("Trying to find yt-dlp in system PATH using shutil.which...")
-    system_yt_dlp = shutil.which('yt-dlp')
-    if system_yt_dlp:
-        logging.info(f"Found yt-dlp in system PATH: {system_yt_dlp}")
-        return system_yt_dlp
-    else:
-        logging.warning("shutil.which could not find yt-dlp in PATH")
+                logger.warning(f"yt-dlp --version failed: {result.stderr.strip()}")
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"Could not run yt-dlp --version: {e}")
+        
+        logger.info(f"Using yt-dlp {yt_dlp_version or '(unknown version)'} at {yt_dlp_executable}")
+        return yt_dlp_executable, yt_dlp_version
+
+def get_yt_dlp_path():
+    """Get the path to the yt-dlp executable, or None if it isn't installed"""
+    return resolve_yt_dlp()[0]
+
+def load_yt_dlp_module():
+    """Import yt_dlp for the in-process engine, from the installed package or the yt-dlp binary
     
-    # Create a new yt-dlp-wrapper script in the current directory as a last resort
-    try:
-        logging.info("Attempting to create a new yt-dlp wrapper script as last resort...")
-        wrapper_dir = os.path.join(cwd, 'bin')
-        os.makedirs(wrapper_dir, exist_ok=True)
-        wrapper_path = os.path.join(wrapper_dir, 'yt-dlp-fallback')
-        
-        with open(wrapper_path, 'w') as f:
-            f.write('''#!/bin/bash
-# This is an auto-generated fallback script for yt-dlp
-# It tries multiple locations where yt-dlp might be installed
+    The release binary is a zipapp, so it can be imported straight from the
+    resolved path. Returns None when neither is available.
+    """
+    global yt_dlp_module
+    
+    if yt_dlp_module is None:
+        path = get_yt_dlp_path()
+        with yt_dlp_lock:
+            if yt_dlp_module is None:
+                try:
+                    yt_dlp_module = importlib.import_module('yt_dlp')
+                except ImportError:
+                    yt_dlp_module = False
+                    if path and zipfile.is_zipfile(path):
+                        sys.path.append(path)
+                        try:
+                            yt_dlp_module = importlib.import_module('yt_dlp')
+                        except ImportError as e:
+                            logger.warning(f"Cannot import yt_dlp from {path}: {e}")
+                if yt_dlp_module:
+                    logger.info(f"In-process yt-dlp engine available (version {yt_dlp_module.version.__version__})")
+                else:
+                    logger.warning("yt_dlp module not available, downloads use the yt-dlp subprocess")
+    return yt_dlp_module or None
 
-# Log our execution for debugging
-echo "yt-dlp-fallback wrapper executing, looking for yt-dlp..." >&2
+def use_python_engine():
+    """Check whether links should be extracted and downloaded in-process (YT_DLP_ENGINE=python)"""
+    from app import app
+    return app.config["YT_DLP_ENGINE"] == 'python' and load_yt_dlp_module() is not None
 
-# Try multiple locations
-for cmd in "/app/bin/yt-dlp" "/usr/local/bin/yt-dlp" "/opt/stacks/nickclips/bin/yt-dlp" "yt-dlp"; do
-    if [ -x "$cmd" ]; then
-        echo "Found yt-dlp at $cmd, executing..." >&2
-        exec "$cmd" "$@"
-    elif command -v "$cmd" >/dev/null 2>&1; then
-        echo "Found yt-dlp command: $cmd, executing..." >&2
-        exec "$cmd" "$@"
-    fi
-done
+def ydl_options(**extra):
+    """YoutubeDL options matching the command line arguments of the subprocess engine"""
+    from app import app
+    yt_dlp = load_yt_dlp_module()
+    
+    options = {
+        'http_headers': {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'},
+        'nocheckcertificate': True,
+        'geo_bypass': True,
+        'noplaylist': True,
+        'socket_timeout': 30,
+        'quiet': True,
+        'noprogress': True,
+        'logger': logger,
+    }
+    if app.config["YT_DLP_PROXY"]:
+        options['proxy'] = app.config["YT_DLP_PROXY"]
+    if app.config["YT_DLP_RATE_LIMIT"]:
+        options['ratelimit'] = yt_dlp.utils.parse_bytes(app.config["YT_DLP_RATE_LIMIT"])
+    if app.config["YT_DLP_MAX_DURATION"] > 0:
+        options['match_filter'] = yt_dlp.utils.match_filter_func(f'duration < {app.config["YT_DLP_MAX_DURATION"]}')
+    options.update(extra)
+    return options
 
-echo "ERROR: yt-dlp not found in any location" >&2
-exit 1
-''')
-        
-        os.chmod(wrapper_path, 0o755)  # Make executable
-        logging.info(f"Created fallback wrapper at {wrapper_path}")
-        return wrapper_path
-    except Exception as e:
-        logging.error(f"Failed to create fallback wrapper: {str(e)}")
+def job_youtube_dl(options, stage, duration=None):
+    """A YoutubeDL that checks the job's cancellation and the stage budget before every HTTP request
+    
+    Extraction and downloads are sequences of requests, each bounded by
+    socket_timeout, so a hung link fails like a subprocess that outlived its
+    budget. yt-dlp's own ffmpeg merge is not covered: it is started by yt-dlp
+    outside process_runner, so a job can neither cancel nor time it out.
+    """
+    yt_dlp = load_yt_dlp_module()
+    video_id = current_video_id()
+    budget = stage_timeout(stage, duration)
+    deadline = time.monotonic() + budget
     
-    # Log warning about potential issues
-    logging.warning("CRITICAL: Could not find yt-dlp at any location. " +
-                   "Falling back to 'yt-dlp' command, but this will likely fail.")
+    def check_job(*args):
+        raise_if_cancelled(video_id)
+        if time.monotonic() > deadline:
+            raise TransientError(f"{stage} stage exceeded its {budget:.0f}s budget")
     
-    # Default to just 'yt-dlp' and hope it's in the PATH
-    return 'yt-dlp'
+    class JobYoutubeDL(yt_dlp.YoutubeDL):
+        def urlopen(self, req):
+            check_job()
+            return super().urlopen(req)
+    
+    # Progress hooks run on this thread too, between the requests of a long download
+    options = dict(options, progress_hooks=[check_job] + list(options.get('progress_hooks', [])))
+    return JobYoutubeDL(options)
 
-# Get the yt-dlp path once at module load time
-logging.info("==== STARTING YT-DLP PATH RESOLUTION ====")
-YT_DLP_PATH = get_yt_dlp_path()
-logging.info(f"==== RESOLVED YT-DLP PATH: {YT_DLP_PATH} ====")
+def extract_info_in_process(url):
+    """Extract a link's metadata with the in-process engine
+    
+    Returns yt-dlp's info dict (JSON-serializable, like --print-json), or
+    None when the link can't be extracted. Raises TransientError for rate
+    limits and outages.
+    """
+    yt_dlp = load_yt_dlp_module()
+    try:
+        with job_youtube_dl(ydl_options(), 'metadata') as ydl:
+            info = ydl.extract_info(url, download=False)
+            if not info:
+                logger.error(f"yt-dlp returned no info for {url}")
+                return None
+            return ydl.sanitize_info(info)
+    except yt_dlp.utils.DownloadError as e:
+        logger.error(f"In-process yt-dlp extraction failed: {e}")
+        if is_transient_error(e):
+            raise TransientError(f"yt-dlp info: {e}") from e
+        return None
+    except Exception as e:
+        logger.error(f"Error extracting info in-process: {e}")
+        if is_transient_error(e):
+            raise TransientError(f"yt-dlp info: {e}") from e
+        return None
 
-# Setup logging
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+def download_in_process(url, info, output_template, duration=None):
+    """Download a link from its already extracted info dict with the in-process engine
+    
+    The formats are selected from `info`, so the page is not extracted again.
+    Returns the downloaded file's path, or None on failure.
+    """
+    yt_dlp = load_yt_dlp_module()
+    
+    if 'reddit.com' in url.lower():
+        # Reddit serves separate DASH video and audio streams
+        format_selector = 'bestvideo+bestaudio/best'
+    else:
+        format_selector = 'best[ext=mp4]/best'
+    
+    options = ydl_options(
+        outtmpl={'default': output_template},
+        format=format_selector,
+        merge_output_format='mp4',
+        concurrent_fragment_downloads=5,
+    )
+    
+    try:
+        with job_youtube_dl(options, 'download', duration) as ydl:
+            result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+    except yt_dlp.utils.DownloadError as e:
+        logger.error(f"In-process yt-dlp download failed: {e}")
+        if is_transient_error(e):
+            raise TransientError(f"yt-dlp: {e}") from e
+        return None
+    
+    downloads = (result or {}).get('requested_downloads') or []
+    downloaded_file = downloads[0].get('filepath') if downloads else None
+    if downloaded_file and os.path.exists(downloaded_file):
+        return downloaded_file
+    logger.error(f"In-process yt-dlp download of {url} produced no file")
+    return None
+
+def summarize_info(info):
+    """Reduce a yt-dlp info dict to the fields used for the video record"""
+    return {
+        'title': info.get('title', 'Untitled'),
+        'description': info.get('description', ''),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail'),
+        'ext': info.get('ext', 'mp4')
+    }
 
 def validate_url(url):
     """Validate if a URL is supported by yt-dlp"""
@@ -167,23 +312,104 @@ def validate_url(url):
     except Exception:
         return False
 
-def queue_download(video_id, url):
-    """Queue a video for download and processing"""
-    thread = threading.Thread(target=download_video, args=(video_id, url))
-    thread.daemon = True
-    thread.start()
+def canonicalize_url(url):
+    """Normalize a link so that different shares of the same video compare equal
+    
+    Lowercases the scheme and host, maps host aliases (youtu.be, x.com,
+    old.reddit.com, ...) to one name, and drops tracking parameters, the
+    fragment and a trailing slash.
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    path = parsed.path
+    query = parse_qsl(parsed.query, keep_blank_values=True)
+    
+    # youtu.be/<id> and youtube.com/shorts/<id> are the watch page of the same video
+    if host in ('youtu.be', 'www.youtu.be'):
+        query = [('v', path.strip('/'))] + query
+        host, path = 'www.youtube.com', '/watch'
+    host = URL_HOST_ALIASES.get(host, host)
+    if host == 'www.youtube.com' and path.startswith('/shorts/'):
+        query = [('v', path.split('/')[2])] + query
+        path = '/watch'
+    
+    site_params = next((params for domain, params in SITE_TRACKING_PARAMS.items()
+                        if host == domain or host.endswith('.' + domain)), set())
+    query = sorted((key, value) for key, value in query
+                   if not key.lower().startswith('utm_')
+                   and key.lower() not in TRACKING_PARAMS and key.lower() not in site_params)
+    
+    if path != '/':
+        path = path.rstrip('/')
+    netloc = f"{host}:{parsed.port}" if parsed.port else host
+    return urlunparse(((parsed.scheme or 'https').lower(), netloc, path, '', urlencode(query), ''))
+
+def metadata_cache_key(url):
+    """Key a link by its canonical URL, or as given if it cannot be parsed"""
+    try:
+        return canonicalize_url(url)
+    except ValueError:
+        return url
+
+def get_cached_metadata(url):
+    """Return the (info, info JSON) extracted for a link within METADATA_CACHE_TTL, if any"""
+    key = metadata_cache_key(url)
+    with metadata_cache_lock:
+        entry = metadata_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, info, info_json = entry
+        if expires_at < time.monotonic():
+            del metadata_cache[key]
+            return None
+        return info, info_json
+
+def cache_metadata(url, info, info_json=None):
+    """Remember a link's extracted metadata, and the info JSON for --load-info-json, for METADATA_CACHE_TTL"""
+    from app import app
+    
+    ttl = app.config["METADATA_CACHE_TTL"]
+    if ttl <= 0 or not info:
+        return
+    
+    key = metadata_cache_key(url)
+    now = time.monotonic()
+    with metadata_cache_lock:
+        # Drop expired entries, then the oldest ones over the size limit
+        for expired in [k for k, entry in metadata_cache.items() if entry[0] < now]:
+            del metadata_cache[expired]
+        metadata_cache.pop(key, None)
+        while len(metadata_cache) >= METADATA_CACHE_SIZE:
+            del metadata_cache[next(iter(metadata_cache))]
+        metadata_cache[key] = (now + ttl, info, info_json)
+
+def queue_download(video):
+    """Queue a video for download and processing
+    
+    The download is persisted on the processing queue and picked up by one of
+    the DOWNLOAD_CONCURRENCY download workers, so it survives restarts. A link
+    that was already downloaded and processed is linked to those outputs
+    instead, leaving the video completed.
+    """
+    from video_processor import enqueue_download
+    enqueue_download(video)
     return True
 
 def download_video(video_id, url):
-    """Download a video from a URL using yt-dlp"""
+    """Download a video from a URL using yt-dlp
+    
+    Raises TransientError when the failure is worth retrying later.
+    """
     from app import app
     
-    with app.app_context():
+    # The job scope lets delete_video cancel the yt-dlp processes of this download
+    with job_scope(video_id), app.app_context():
         video = Video.query.get(video_id)
         if not video:
             logger.error(f"Video {video_id} not found")
             return False
         
+        info_file = None
         try:
             logger.info(f"Downloading video from URL: {url}")
             
@@ -203,11 +429,35 @@ def download_video(video_id, url):
             # Set output filename template
             output_template = os.path.join(output_dir, f"{video.slug}.%(ext)s")
             
+            # yt-dlp's info JSON, saved by the first extraction and loaded by every download attempt
+            fd, info_file = tempfile.mkstemp(prefix=f"{video.slug}-", suffix='.info.json')
+            os.close(fd)
+            
             # Get video info first to set title and description
             info = None
+            extracted = None
+            
+            # Reuse the metadata of a recent extraction of the same link
+            cached = get_cached_metadata(url)
+            if cached:
+                logger.info(f"Using cached metadata for {url}")
+                info, info_json = cached
+                if info_json:
+                    with open(info_file, 'w') as f:
+                        f.write(info_json)
+                    if use_python_engine():
+                        extracted = json.loads(info_json)
+            
+            # The in-process engine extracts the link once, the same info then drives the download
+            if not info and use_python_engine():
+                extracted = extract_info_in_process(url)
+                if extracted:
+                    info = summarize_info(extracted)
+                    with open(info_file, 'w') as f:
+                        json.dump(extracted, f)
             
             # For Reddit URLs, try direct info extraction first
-            if 'reddit.com' in url.lower():
+            if not info and 'reddit.com' in url.lower():
                 logger.info("Attempting direct Reddit info extraction first...")
                 info = get_reddit_info_directly(url)
                 if info:
@@ -217,7 +467,7 @@ def download_video(video_id, url):
             
             # If not Reddit or direct Reddit info extraction failed, try yt-dlp
             if not info:
-                info = get_video_info(url)
+                info = get_video_info(url, info_file)
             
             if info:
                 video.title = info.get('title', 'Untitled')
@@ -236,11 +486,35 @@ def download_video(video_id, url):
                     logger.info("No info available, directly proceeding with Reddit download attempt")
                     # Continue with download attempts - don't return False yet
             
+            # Size the download time budget from the reported duration
+            duration = info.get('duration') if info else None
+            
+            # Info from the direct Reddit extraction can't be loaded by yt-dlp, extract once for the downloads
+            if not os.path.getsize(info_file) and 'reddit.com' in url.lower():
+                get_video_info(url, info_file)
+            saved_info = info_file if os.path.getsize(info_file) else None
+            
+            if info and not cached:
+                info_json = None
+                if saved_info:
+                    with open(saved_info) as f:
+                        info_json = f.read()
+                cache_metadata(url, info, info_json)
+            
             # For Reddit URLs, try direct download first
             downloaded_file = None
-            if 'reddit.com' in url.lower():
+            reddit_error = None
+            if extracted:
+                downloaded_file = download_in_process(url, extracted, output_template, duration)
+                if not downloaded_file:
+                    logger.info("In-process download failed, falling back to the yt-dlp subprocess...")
+            
+            if not downloaded_file and 'reddit.com' in url.lower():
                 logger.info("Attempting direct Reddit video download first...")
-                downloaded_file = try_reddit_direct_download(url, output_template)
+                try:
+                    downloaded_file = try_reddit_direct_download(url, output_template, duration, saved_info)
+                except TransientError as e:
+                    reddit_error = e
                 
                 if downloaded_file and os.path.exists(downloaded_file):
                     logger.info(f"Direct Reddit download succeeded: {downloaded_file}")
@@ -249,9 +523,12 @@ def download_video(video_id, url):
             
             # If not Reddit or direct Reddit download failed, try yt-dlp
             if not downloaded_file or not os.path.exists(downloaded_file):
-                downloaded_file = download_with_ytdlp(url, output_template)
+                downloaded_file = download_with_ytdlp(url, output_template, duration, saved_info)
             
             if not downloaded_file or not os.path.exists(downloaded_file):
+                if reddit_error:
+                    raise reddit_error
+                
                 # Check for platform-specific error messages
                 if 'youtube.com' in url.lower() or 'youtu.be' in url.lower():
                     error_msg = "YouTube restricts automated downloads on shared hosting. This feature will work on your self-hosted setup."
@@ -267,21 +544,33 @@ def download_video(video_id, url):
                 return False
             
             # Update the video record
+            from video_processor import enqueue_video, hash_file
             video.original_path = downloaded_file
+            video.content_hash = hash_file(downloaded_file)
             video.status = 'pending'
             db.session.commit()
             
-            # Add to processing queue
-            queue_item = ProcessingQueue(video_id=video.id, priority=1)
-            db.session.add(queue_item)
-            db.session.commit()
-            
-            # Start processing
-            from video_processor import process_next
-            process_next()
+            # Add to processing queue (or link to an identical video's outputs)
+            enqueue_video(video, priority=1)
             
             return True
             
+        except JobCancelled:
+            # The video was deleted while downloading, delete_video cleans up after it
+            logger.info(f"Download of video {video_id} was cancelled")
+            db.session.rollback()
+            return False
+            
+        except TransientError:
+            db.session.rollback()
+            raise
+            
+        except StaleDataError:
+            # The video was deleted, possibly through another process, before the download was recorded
+            logger.info(f"Video {video_id} was deleted during its download")
+            db.session.rollback()
+            return False
+            
         except Exception as e:
             logger.exception(f"Error downloading video from {url}: {e}")
             
@@ -298,6 +587,10 @@ def download_video(video_id, url):
             db.session.commit()
             
             return False
+            
+        finally:
+            if info_file and os.path.exists(info_file):
+                os.remove(info_file)
 
 def get_reddit_info_directly(url):
     """Get Reddit video information directly from the page, without yt-dlp"""
@@ -360,8 +653,12 @@ def get_reddit_info_directly(url):
         logger.error(f"Error getting Reddit info directly: {e}")
         return None
 
-def get_video_info(url):
-    """Get video information using yt-dlp without downloading with enhanced error handling"""
+def get_video_info(url, info_file=None):
+    """Get video information using yt-dlp without downloading with enhanced error handling
+    
+    The full info JSON is saved to `info_file`, if given, for the download
+    to load with --load-info-json.
+    """
     try:
         # Skip if URL is from our own domain
         if 'replit.dev' in url.lower() or 'repl.co' in url.lower():
@@ -371,29 +668,8 @@ def get_video_info(url):
         # Import Flask app to get configuration
         from app import app
         
-        # Before running command, do a sanity check to make sure yt-dlp exists
-        ytdlp_exists = False
-        ytdlp_paths_to_try = [
-            YT_DLP_PATH,  # First try the module-level resolved path
-            '/app/bin/yt-dlp',
-            '/usr/local/bin/yt-dlp',
-            '/usr/bin/yt-dlp',
-            '/opt/stacks/nickclips/bin/yt-dlp',
-            os.path.join(os.getcwd(), 'bin', 'yt-dlp'),
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'yt-dlp'),
-            shutil.which('yt-dlp')  # Finally try using PATH
-        ]
-        
-        actual_ytdlp_path = None
-        for path in ytdlp_paths_to_try:
-            if path and os.path.isfile(path) and os.access(path, os.X_OK):
-                ytdlp_exists = True
-                actual_ytdlp_path = path
-                logger.info(f"Found usable yt-dlp for info retrieval at: {actual_ytdlp_path}")
-                break
-        
-        if not ytdlp_exists:
-            logger.error("yt-dlp executable not found in any location for info retrieval!")
+        actual_ytdlp_path = get_yt_dlp_path()
+        if not actual_ytdlp_path:
             return None
         
         # Common command arguments for all sites
@@ -452,7 +728,7 @@ def get_video_info(url):
         logger.info(f"Running video info command: {' '.join(cmd)}")
         
         # Run the command and capture output
-        process = subprocess.run(cmd, capture_output=True, text=True)
+        process = run_process(cmd, 'metadata')
         
         # Log the output for debugging
         if process.stderr:
@@ -465,15 +741,12 @@ def get_video_info(url):
             raise Exception("No JSON data returned from yt-dlp")
         
         info = json.loads(process.stdout)
+        if info_file:
+            with open(info_file, 'w') as f:
+                f.write(process.stdout)
         
         # Extract useful information
-        result = {
-            'title': info.get('title', 'Untitled'),
-            'description': info.get('description', ''),
-            'duration': info.get('duration'),
-            'thumbnail': info.get('thumbnail'),
-            'ext': info.get('ext', 'mp4')
-        }
+        result = summarize_info(info)
         
         # Add more debug logging
         logger.debug(f"Got video info: {result}")
@@ -495,12 +768,42 @@ def get_video_info(url):
             logger.error(f"yt-dlp stderr: {e.stderr}")
         if hasattr(e, 'stdout') and e.stdout:
             logger.error(f"yt-dlp stdout: {e.stdout}")
+        if is_transient_error(e.stderr):
+            raise TransientError(f"yt-dlp info: {e.stderr.strip().splitlines()[-1]}") from e
         return None
     except Exception as e:
         logger.error(f"Error getting video info: {e}")
+        if is_transient_error(e):
+            raise TransientError(f"yt-dlp info: {e}") from e
         return None
 
-def try_reddit_direct_download(url, output_path):
+def source_args(url, info_file=None):
+    """yt-dlp arguments naming what to download: the saved info JSON if there is one, else the URL"""
+    if info_file:
+        return ['--load-info-json', info_file]
+    return [url]
+
+def reddit_format_from_info(info_file):
+    """Pick the best Reddit DASH video format, merged with the best audio, from a saved info JSON"""
+    try:
+        with open(info_file) as f:
+            formats = json.load(f).get('formats') or []
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read formats from {info_file}: {e}")
+        return None
+    
+    videos = [fmt for fmt in formats
+              if str(fmt.get('format_id', '')).startswith('dash') and fmt.get('vcodec') != 'none']
+    if not videos:
+        return None
+    best = max(videos, key=lambda fmt: (fmt.get('height') or 0, fmt.get('tbr') or 0))
+    return f"{best['format_id']}+bestaudio/{best['format_id']}"
+
+def is_transient_response(response):
+    """Check whether an HTTP response is a rate limit or server-side error worth retrying later"""
+    return response.status_code == 429 or response.status_code >= 500
+
+def try_reddit_direct_download(url, output_path, duration=None, info_file=None):
     """
     Simplified Reddit downloader with better reliability and error handling.
     Completely rebuilt to avoid all previous issues.
@@ -512,6 +815,9 @@ def try_reddit_direct_download(url, output_path):
     output_base = os.path.splitext(output_path)[0]
     output_file = f"{output_base}.mp4"
     
+    # Rate limits and outages seen along the way, reported if every approach fails
+    transient_errors = []
+    
     # Try direct YouTube-DL approach with specific Reddit format selector
     try:
         yt_dlp_path = get_yt_dlp_path()
@@ -525,13 +831,12 @@ def try_reddit_direct_download(url, output_path):
             "--merge-output-format", "mp4",
             "--no-playlist",
             "-o", output_file,
-            "--no-warnings",
-            url
-        ]
+            "--no-warnings"
+        ] + source_args(url, info_file)
         
         # Run yt-dlp for Reddit
         logger.info(f"Running specialized Reddit download: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_process(cmd, 'download', duration)
         
         # Check if file was created and has size
         if os.path.exists(output_file) and os.path.getsize(output_file) > 1000:
@@ -539,8 +844,12 @@ def try_reddit_direct_download(url, output_path):
             return output_file
         else:
             logger.warning("yt-dlp failed to download Reddit video, trying fallback method")
+            if is_transient_error(result.stderr):
+                transient_errors.append(f"yt-dlp: {result.stderr.strip().splitlines()[-1]}")
     except Exception as e:
         logger.error(f"Error in yt-dlp download: {str(e)}")
+        if is_transient_error(e):
+            transient_errors.append(f"yt-dlp: {e}")
     
     # Try fallback direct HTTP approach
     try:
@@ -571,6 +880,8 @@ def try_reddit_direct_download(url, output_path):
                 api_headers = headers.copy()
                 api_headers['Accept'] = 'application/json'
                 json_response = session.get(json_url, headers=api_headers, timeout=10)
+                if is_transient_response(json_response):
+                    transient_errors.append(f"Reddit API returned HTTP {json_response.status_code}")
                 
                 if json_response.status_code == 200:
                     data = json_response.json()
@@ -586,6 +897,8 @@ def try_reddit_direct_download(url, output_path):
                                     
                                     # Download the video
                                     video_response = session.get(video_url, stream=True, timeout=30)
+                                    if is_transient_response(video_response):
+                                        transient_errors.append(f"{video_url} returned HTTP {video_response.status_code}")
                                     if video_response.status_code == 200:
                                         with open(output_file, 'wb') as f:
                                             for chunk in video_response.iter_content(chunk_size=8192):
@@ -596,10 +909,14 @@ def try_reddit_direct_download(url, output_path):
                                             return output_file
             except Exception as e:
                 logger.warning(f"Reddit API download failed: {str(e)}")
+                if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                    transient_errors.append(f"Reddit API: {e}")
                 
         # If API approach failed, try direct page scraping
         try:
             page_response = session.get(url, timeout=30)
+            if is_transient_response(page_response):
+                transient_errors.append(f"Reddit page returned HTTP {page_response.status_code}")
             if page_response.status_code == 200:
                 html = page_response.text
                 
@@ -632,6 +949,8 @@ def try_reddit_direct_download(url, output_path):
                         try:
                             logger.info(f"Trying to download: {video_url}")
                             video_response = session.get(video_url, stream=True, timeout=30)
+                            if is_transient_response(video_response):
+                                transient_errors.append(f"{video_url} returned HTTP {video_response.status_code}")
                             
                             if video_response.status_code == 200:
                                 with open(output_file, 'wb') as f:
@@ -643,18 +962,31 @@ def try_reddit_direct_download(url, output_path):
                                     return output_file
                         except Exception as dl_err:
                             logger.warning(f"Failed to download {video_url}: {str(dl_err)}")
+                            if isinstance(dl_err, (requests.ConnectionError, requests.Timeout)):
+                                transient_errors.append(f"{video_url}: {dl_err}")
         except Exception as page_err:
             logger.warning(f"Page scraping failed: {str(page_err)}")
+            if isinstance(page_err, (requests.ConnectionError, requests.Timeout)):
+                transient_errors.append(f"Reddit page: {page_err}")
                 
         # All approaches failed
         logger.error("All Reddit download approaches failed")
+        if transient_errors:
+            # Worth another try later rather than a permanent failure
+            raise TransientError("; ".join(transient_errors))
         return None
+    except TransientError:
+        raise
     except Exception as e:
         logger.error(f"Error in Reddit download process: {str(e)}")
         return None
 
-def download_with_ytdlp(url, output_template):
-    """Download a video using yt-dlp with enhanced error recovery"""
+def download_with_ytdlp(url, output_template, duration=None, info_file=None):
+    """Download a video using yt-dlp with enhanced error recovery
+    
+    With `info_file` (saved by get_video_info) the download loads the
+    extracted info instead of extracting the page again.
+    """
     try:
         # Skip if URL is from our own domain
         if 'replit.dev' in url.lower() or 'repl.co' in url.lower():
@@ -664,29 +996,8 @@ def download_with_ytdlp(url, output_template):
         # Import Flask app to get configuration
         from app import app
         
-        # Before running command, do a sanity check to make sure yt-dlp exists
-        ytdlp_exists = False
-        ytdlp_paths_to_try = [
-            YT_DLP_PATH,  # First try the module-level resolved path
-            '/app/bin/yt-dlp',
-            '/usr/local/bin/yt-dlp',
-            '/usr/bin/yt-dlp',
-            '/opt/stacks/nickclips/bin/yt-dlp',
-            os.path.join(os.getcwd(), 'bin', 'yt-dlp'),
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'yt-dlp'),
-            shutil.which('yt-dlp')  # Finally try using PATH
-        ]
-        
-        actual_ytdlp_path = None
-        for path in ytdlp_paths_to_try:
-            if path and os.path.isfile(path) and os.access(path, os.X_OK):
-                ytdlp_exists = True
-                actual_ytdlp_path = path
-                logger.info(f"Found usable yt-dlp for download at: {actual_ytdlp_path}")
-                break
-        
-        if not ytdlp_exists:
-            logger.error("yt-dlp executable not found in any location for download!")
+        actual_ytdlp_path = get_yt_dlp_path()
+        if not actual_ytdlp_path:
             # Try to install it as last resort
             try:
                 logger.info("Attempting emergency yt-dlp installation...")
@@ -736,43 +1047,18 @@ def download_with_ytdlp(url, output_template):
             # REDDIT HANDLING: Complete special case handling for Reddit URLs
             logger.info("Using ENHANCED Reddit-specific download parameters")
             
-            # First, try to list available formats for debugging and use these formats explicitly
-            reddit_formats = []
-            try:
-                available_formats_cmd = [
-                    actual_ytdlp_path,
-                    '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                    '--list-formats',
-                    '--verbose',
-                    '--no-check-certificate',
-                    '--geo-bypass',
-                    url
-                ]
-                logger.info(f"Checking available Reddit formats: {' '.join(available_formats_cmd)}")
-                format_process = subprocess.run(available_formats_cmd, capture_output=True, text=True)
-                
-                # Parse stdout to extract format IDs 
-                if format_process.stdout:
-                    logger.info(f"Available Reddit formats: {format_process.stdout}")
-                    
-                    # Parse format listing to extract available format IDs
-                    for line in format_process.stdout.splitlines():
-                        if line.strip() and 'ID  ' not in line and '[info]' not in line:
-                            parts = line.split()
-                            if parts and parts[0].isdigit():
-                                reddit_formats.append(parts[0])
-                    
-                    logger.info(f"Extracted Reddit format IDs: {reddit_formats}")
-                
-                if format_process.stderr:
-                    logger.info(f"Format listing stderr: {format_process.stderr}")
-            except Exception as e:
-                logger.warning(f"Format listing error: {e}")
+            # Pick the format from the extracted info rather than listing the formats with yt-dlp again
+            best_format = reddit_format_from_info(info_file) if info_file else None
+            if best_format:
+                logger.info(f"Using format {best_format} for Reddit download")
+            else:
+                best_format = 'bestaudio+bestvideo/best'
+                logger.info("Using bestaudio+bestvideo format for Reddit download")
             
-            # Base command with mandatory options
             cmd = [
                 actual_ytdlp_path,
                 '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
+                '--format', best_format,
                 '--output', output_template,
                 '--no-check-certificate',
                 '--geo-bypass',
@@ -783,80 +1069,9 @@ def download_with_ytdlp(url, output_template):
                 '--add-header', 'DNT: 1',
                 '--socket-timeout', '30',  # Increase timeout for slower connections
                 '--retries', '10',         # Increase retry attempts
-                '--fragment-retries', '10' # Increase fragment retry attempts
-            ]
-            
-            # For Reddit, we need to first list available formats, then pick one explicitly
-
-            # Step 1: Get available formats
-            logger.info("Running yt-dlp to list available formats for Reddit video")
-            formats_cmd = [
-                actual_ytdlp_path,
-                '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-                '--list-formats',
-                '--no-check-certificate',
-                '--verbose',
-                url
-            ]
-            
-            # Run the format listing command
-            format_ids = []  # Initialize here to avoid "possibly unbound" error
-            try:
-                formats_process = subprocess.run(formats_cmd, capture_output=True, text=True)
-                if formats_process.stdout:
-                    logger.info(f"Format listing output: {formats_process.stdout}")
-                    
-                    # Parse the output to find available format IDs
-                    for line in formats_process.stdout.splitlines():
-                        if 'dash-video' in line or 'dash-audio' in line:
-                            # Extract format IDs for dash formats
-                            parts = line.split()
-                            if parts and parts[0].isdigit():
-                                format_ids.append(parts[0])
-                
-                # If we found dash formats, use them explicitly
-                if format_ids:
-                    logger.info(f"Found dash format IDs: {format_ids}")
-                    best_format = format_ids[0]  # Use the first one (usually best)
-                    
-                    # Step 2: Use the explicit format ID
-                    cmd = [
-                        actual_ytdlp_path,
-                        '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-                        '--format', best_format,
-                        '--output', output_template,
-                        '--no-check-certificate',
-                        '--verbose',
-                        '--no-playlist',
-                        url
-                    ]
-                    logger.info(f"Using format ID {best_format} for Reddit download")
-                else:
-                    # No dash formats found, try with "bestaudio+bestvideo" format
-                    cmd = [
-                        actual_ytdlp_path,
-                        '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-                        '--format', 'bestaudio+bestvideo/best',
-                        '--output', output_template,
-                        '--no-check-certificate',
-                        '--verbose',
-                        '--no-playlist',
-                        url
-                    ]
-                    logger.info("Using bestaudio+bestvideo format for Reddit download")
-            except Exception as e:
-                logger.error(f"Error listing formats: {e}")
-                # Fallback to a simpler command with no format specification
-                cmd = [
-                    actual_ytdlp_path,
-                    '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-                    '--output', output_template,
-                    '--no-check-certificate',
-                    '--verbose',
-                    '--no-playlist',
-                    url
-                ]
-                logger.info("Failed to get formats, using minimal command for Reddit download")
+                '--fragment-retries', '10',  # Increase fragment retry attempts
+                '--no-playlist'
+            ] + source_args(url, info_file)
             
             # Add the rate limit for shared hosting
             if app.config["YT_DLP_RATE_LIMIT"]:
@@ -871,23 +1086,21 @@ def download_with_ytdlp(url, output_template):
             cmd = [actual_ytdlp_path] + base_args + [
                 '--format', 'best[ext=mp4]/best',
                 '--merge-output-format', 'mp4',
-                '--concurrent-fragments', '5',  # Use 5 fragments at a time
-                url
-            ]
+                '--concurrent-fragments', '5'  # Use 5 fragments at a time
+            ] + source_args(url, info_file)
         else:
             # Default command for all other sites
             logger.info("Using default download parameters")
             cmd = [actual_ytdlp_path] + base_args + [
                 '--format', 'best[ext=mp4]/best',
-                '--merge-output-format', 'mp4',
-                url
-            ]
+                '--merge-output-format', 'mp4'
+            ] + source_args(url, info_file)
         
         # Log the full command for debugging
         logger.info(f"Running download command: {' '.join(str(arg) for arg in cmd)}")
         
         # Run the command and capture output
-        process = subprocess.run(cmd, capture_output=True, text=True)
+        process = run_process(cmd, 'download', duration)
         
         # Log the output for debugging
         if process.stdout:
@@ -915,7 +1128,11 @@ def download_with_ytdlp(url, output_template):
             logger.error(f"yt-dlp stderr: {e.stderr}")
         if e.stdout:
             logger.error(f"yt-dlp stdout: {e.stdout}")
+        if is_transient_error(e.stderr):
+            raise TransientError(f"yt-dlp: {e.stderr.strip().splitlines()[-1]}") from e
         return None
     except Exception as e:
         logger.error(f"Error downloading with yt-dlp: {e}")
+        if is_transient_error(e):
+            raise TransientError(f"yt-dlp: {e}") from e
         return None
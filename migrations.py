@@ -2,34 +2,75 @@ import os
 import sys
 import logging
 from app import app, db
-from sqlalchemy import text
+from sqlalchemy import text, inspect
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def add_column_if_missing(table, column, definition):
+    """Add a column to an existing table if it is not there yet"""
+    columns = [col['name'] for col in inspect(db.engine).get_columns(table)]
+    if column in columns:
+        logger.info(f"{column} column already exists in {table} table")
+        return False
+    
+    logger.info(f"Adding {column} column to {table} table...")
+    db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+    db.session.commit()
+    return True
+
 def run_migrations():
     """Run database migrations manually"""
     with app.app_context():
         try:
-            # Check if user_id column exists in video table
-            result = db.session.execute(text(
-                "SELECT column_name FROM information_schema.columns "
-                "WHERE table_name='video' AND column_name='user_id'"
-            ))
-            
-            # If user_id doesn't exist, add it
-            if result.rowcount == 0:
-                logger.info("Adding user_id column to video table...")
-                db.session.execute(text(
-                    "ALTER TABLE video ADD COLUMN user_id INTEGER REFERENCES \"user\" (id) ON DELETE SET NULL"
-                ))
-                db.session.commit()
-                logger.info("Migration completed successfully!")
-            else:
-                logger.info("user_id column already exists in video table")
+            # Video ownership
+            add_column_if_missing('video', 'user_id', 'INTEGER REFERENCES "user" (id) ON DELETE SET NULL')
+            
+            # Cross-process job claiming
+            add_column_if_missing('processing_queue', 'worker_id', 'VARCHAR(128)')
+            add_column_if_missing('processing_queue', 'lease_expires_at', 'TIMESTAMP')
+            
+            # Remux fast path bookkeeping
+            add_column_if_missing('processing_queue', 'processing_mode', 'VARCHAR(20)')
+            
+            # Probe cache
+            add_column_if_missing('video', 'probe_key', 'VARCHAR(512)')
+            add_column_if_missing('video', 'probe_data', 'TEXT')
+            
+            # Live encode progress
+            add_column_if_missing('processing_queue', 'progress', 'FLOAT')
+            add_column_if_missing('processing_queue', 'encode_speed', 'FLOAT')
+            add_column_if_missing('processing_queue', 'eta_seconds', 'FLOAT')
+            add_column_if_missing('processing_queue', 'progress_updated_at', 'TIMESTAMP')
+            
+            # Content-hash deduplication
+            add_column_if_missing('video', 'content_hash', 'VARCHAR(64)')
+            db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_video_content_hash ON video (content_hash)"))
+            db.session.commit()
+            
+            # Lease heartbeats and crash recovery
+            add_column_if_missing('processing_queue', 'heartbeat_at', 'TIMESTAMP')
+            add_column_if_missing('processing_queue', 'attempts', 'INTEGER NOT NULL DEFAULT 0')
+            
+            # Retry backoff
+            add_column_if_missing('processing_queue', 'next_attempt_at', 'TIMESTAMP')
+            
+            # Persistent download queue
+            add_column_if_missing('processing_queue', 'stage', "VARCHAR(20) NOT NULL DEFAULT 'process'")
+            
+            # Reusing the outputs of links that were already downloaded
+            add_column_if_missing('video', 'canonical_url', 'VARCHAR(1024)')
+            db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_video_canonical_url ON video (canonical_url)"))
+            db.session.commit()
+            
+            # Worker capacity reported per stage
+            add_column_if_missing('worker_node', 'download_capacity', 'INTEGER NOT NULL DEFAULT 0')
+            add_column_if_missing('worker_node', 'current_downloads', 'INTEGER NOT NULL DEFAULT 0')
             
             # Additional migrations can be added here
+            
+            logger.info("Migrations completed successfully!")
                 
         except Exception as e:
             logger.error(f"Error during migration: {e}")
@@ -37,4 +78,4 @@ def run_migrations():
             sys.exit(1)
 
 if __name__ == "__main__":
-    run_migrations()
\ No newline at end of file
+    run_migrations()
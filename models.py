@@ -1,3 +1,4 @@
+import os
 import uuid
 import datetime
 from app import db
@@ -47,8 +48,16 @@ class Video(db.Model):
     height = db.Column(db.Integer, nullable=True)
     size = db.Column(db.Integer, nullable=True)  # File size in bytes
     
+    # SHA-256 of the original file, used to share outputs between identical uploads
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+    
+    # Cached ffprobe output for the original file, keyed by path/size/mtime
+    probe_key = db.Column(db.String(512), nullable=True)
+    probe_data = db.Column(db.Text, nullable=True)
+    
     # Source info
     source_url = db.Column(db.String(1024), nullable=True)  # URL if downloaded from the web
+    canonical_url = db.Column(db.String(1024), nullable=True, index=True)  # source_url normalized for finding earlier downloads
     source_type = db.Column(Enum('upload', 'link', name='source_types'), nullable=False)
     
     # Processing status
@@ -80,7 +89,7 @@ class Video(db.Model):
             'slug': self.slug,
             'title': self.title or "Untitled",
             'description': self.description,
-            'thumbnail_path': f"/uploads/thumbnails/{self.slug}.jpg" if self.thumbnail_path else None,
+            'thumbnail_path': f"/uploads/{self.thumbnail_path}" if self.thumbnail_path else None,
             'duration': self.duration,
             'width': self.width,
             'height': self.height,
@@ -95,6 +104,13 @@ class Video(db.Model):
         # Add username if the video has an owner
         if self.owner:
             data['username'] = self.owner.username
+        
+        # Add live encode progress from the most recent queue item
+        queue_item = max(self.queue_items, key=lambda item: item.id, default=None)
+        if queue_item is not None and queue_item.status == 'processing':
+            data['progress'] = queue_item.progress
+            data['encode_speed'] = queue_item.encode_speed
+            data['eta_seconds'] = queue_item.eta_seconds
             
         return data
 
@@ -111,8 +127,102 @@ class ProcessingQueue(db.Model):
     started_at = db.Column(db.DateTime, nullable=True)
     completed_at = db.Column(db.DateTime, nullable=True)
     
+    # Claim info - which worker process holds the job and until when. The worker's
+    # heartbeat renews the lease; expired leases are requeued by the reaper
+    worker_id = db.Column(db.String(128), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)  # Times the job has been claimed
+    next_attempt_at = db.Column(db.DateTime, nullable=True)  # Not claimable before this (retry backoff)
+    
+    # 'download' (fetch a linked video, then queue it for processing) or 'process'
+    stage = db.Column(db.String(20), default='process', nullable=False)
+    
+    # How the outputs were produced: 'transcode' (full re-encode), 'chunked' (re-encoded in
+    # parallel keyframe-aligned chunks), 'remux' (stream copy), 'remux+ladder' (stream copy
+    # with the lower HLS renditions encoded) or 'dedup' (linked to an identical video's outputs)
+    processing_mode = db.Column(db.String(20), nullable=True)
+    
+    # Live encode progress parsed from ffmpeg's -progress output
+    progress = db.Column(db.Float, nullable=True)  # Percent of the source duration encoded
+    encode_speed = db.Column(db.Float, nullable=True)  # Multiple of realtime, e.g. 2.5 = 2.5x
+    eta_seconds = db.Column(db.Float, nullable=True)
+    progress_updated_at = db.Column(db.DateTime, nullable=True)
+    
     # Relationship
     video = db.relationship('Video', backref=db.backref('queue_items', lazy=True))
     
     def __repr__(self):
         return f'<ProcessingQueue {self.id}: Video {self.video_id}>'
+
+class WorkerNode(db.Model):
+    """A process draining the processing queue, kept current by its lease heartbeat"""
+    id = db.Column(db.String(128), primary_key=True)  # host:pid:token, the prefix of its jobs' worker_id
+    hostname = db.Column(db.String(255), nullable=False)
+    pid = db.Column(db.Integer, nullable=False)
+    capacity = db.Column(db.Integer, default=0, nullable=False)  # Jobs it processes at once
+    current_jobs = db.Column(db.Integer, default=0, nullable=False)
+    download_capacity = db.Column(db.Integer, default=0, nullable=False)  # Links it downloads at once
+    current_downloads = db.Column(db.Integer, default=0, nullable=False)
+    started_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    last_heartbeat_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    
+    def is_online(self, lease_seconds):
+        """Whether the node has sent a heartbeat within the last lease period"""
+        return (self.last_heartbeat_at is not None and
+                datetime.datetime.utcnow() - self.last_heartbeat_at < datetime.timedelta(seconds=lease_seconds))
+    
+    def __repr__(self):
+        return f'<WorkerNode {self.id}: {self.current_jobs}/{self.capacity}>'
+
+class UploadSession(db.Model):
+    """A resumable (tus-style) chunked upload that becomes a Video once every byte has arrived"""
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    filename = db.Column(db.String(255), nullable=False)  # Sanitized client filename
+    file_path = db.Column(db.String(512), nullable=False)  # Partial file being written in uploads/original
+    upload_length = db.Column(db.BigInteger, nullable=False)  # Total size in bytes
+    status = db.Column(db.String(20), default='uploading', nullable=False)  # 'uploading', 'finalizing' or 'completed'
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(
+        db.DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    )
+    
+    # Byte ranges received so far (one row per chunk, so parallel PATCHes never contend)
+    chunks = db.relationship('UploadChunk', backref='upload', lazy=True, cascade="all, delete-orphan")
+    
+    def final_path(self):
+        """Permanent name of the finished file, next to the partial one (fixed, so a retaken finalize finds it)"""
+        return os.path.join(os.path.dirname(self.file_path), f"{self.id}_{self.filename}")
+    
+    def received_offset(self):
+        """Length of the contiguous prefix received so far (the tus Upload-Offset)"""
+        ranges = self.received_ranges()
+        return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+    
+    def received_ranges(self):
+        """Merged [start, end) byte ranges received so far"""
+        ranges = []
+        for chunk in sorted(self.chunks, key=lambda chunk: chunk.offset):
+            start, end = chunk.offset, chunk.offset + chunk.length
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        return ranges
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id}: {self.filename}>'
+
+class UploadChunk(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    upload_id = db.Column(db.String(32), db.ForeignKey('upload_session.id', ondelete='CASCADE'), nullable=False, index=True)
+    offset = db.Column(db.BigInteger, nullable=False)
+    length = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<UploadChunk {self.upload_id}: {self.offset}+{self.length}>'
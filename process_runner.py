@@ -0,0 +1,266 @@
+import os
+import re
+import errno
+import random
+import shutil
+import signal
+import functools
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from sqlalchemy.exc import OperationalError
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Wall-clock budget per stage: (fixed seconds, extra seconds per second of source duration)
+STAGE_TIMEOUTS = {
+    'probe': (60, 0),
+    'thumbnail': (120, 0),
+    'split': (120, 0.5),
+    'transcode': (300, 8),
+    'audio': (120, 1),
+    'concat': (120, 0.5),
+    'metadata': (120, 0),
+    'download': (600, 2),
+}
+
+# Duration assumed when a stage's source duration is unknown (seconds)
+UNKNOWN_DURATION = 3600
+
+# Stages that run encoders, which get the CPU/IO scheduling policy (nice, ionice, cgroup quota)
+ENCODER_STAGES = {'thumbnail', 'split', 'transcode', 'audio', 'concat'}
+IONICE_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+# cgroup v2 period for PROCESSING_CPU_QUOTA (microseconds)
+CGROUP_CPU_PERIOD = 100000
+
+# Error output that means "try again later": rate limits, upstream 5xx and network trouble
+TRANSIENT_ERROR_PATTERN = re.compile(
+    r"HTTP Error (429|5\d\d)|Too Many Requests|Service Unavailable|Bad Gateway|Gateway Time-?out"
+    r"|rate.?limit|timed? ?out|Connection (reset|refused|aborted)|Remote end closed"
+    r"|Temporary failure in name resolution|IncompleteRead",
+    re.IGNORECASE
+)
+
+# OS errors that clear up on their own (full disk, exhausted resources, network)
+TRANSIENT_ERRNOS = {errno.ENOSPC, errno.EAGAIN, errno.ENOMEM, errno.ECONNRESET, errno.ECONNREFUSED, errno.ETIMEDOUT}
+
+# Running subprocesses by video id, and the videos whose jobs were cancelled
+job_processes = {}
+active_jobs = {}
+cancelled_jobs = set()
+registry_lock = threading.Lock()
+
+# Video id of the job the current thread is working for
+current_job = threading.local()
+
+# The cgroup encoders are moved into, once configured (False = unavailable)
+encoder_cgroup = None
+encoder_cgroup_lock = threading.Lock()
+
+class JobCancelled(BaseException):
+    """Raised in a job's thread when its video was cancelled
+    
+    Like asyncio.CancelledError this is a BaseException, so the broad
+    `except Exception` fallbacks around each stage don't swallow it and
+    start another subprocess for a job that should stop.
+    """
+
+class TransientError(Exception):
+    """A failure that is expected to go away if the job is retried later (rate limit, outage)"""
+
+@contextmanager
+def job_scope(video_id):
+    """Attribute the subprocesses started by this thread to a video's job"""
+    previous = getattr(current_job, 'video_id', None)
+    current_job.video_id = video_id
+    with registry_lock:
+        active_jobs[video_id] = active_jobs.get(video_id, 0) + 1
+    try:
+        yield
+    finally:
+        current_job.video_id = previous
+        with registry_lock:
+            active_jobs[video_id] -= 1
+            if active_jobs[video_id] == 0:
+                del active_jobs[video_id]
+                cancelled_jobs.discard(video_id)
+
+def current_video_id():
+    """Return the video id of the job the current thread is working for, if any"""
+    return getattr(current_job, 'video_id', None)
+
+def is_cancelled(video_id):
+    """Check whether a video's job has been cancelled"""
+    with registry_lock:
+        return video_id in cancelled_jobs
+
+def raise_if_cancelled(video_id=None):
+    """Raise JobCancelled if the (current) job has been cancelled"""
+    video_id = video_id if video_id is not None else current_video_id()
+    if video_id is not None and is_cancelled(video_id):
+        raise JobCancelled(video_id)
+
+def cancel_job(video_id):
+    """Kill the running subprocesses of a video's job and refuse to start new ones
+    
+    Returns True if the job was running in this process.
+    """
+    with registry_lock:
+        if video_id not in active_jobs:
+            return False
+        cancelled_jobs.add(video_id)
+        processes = list(job_processes.get(video_id, ()))
+    
+    logger.info(f"Cancelling job for video {video_id} ({len(processes)} running processes)")
+    for process in processes:
+        kill_process_group(process)
+    return True
+
+def kill_process_group(process):
+    """Kill a subprocess together with any children it spawned"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def stage_timeout(stage, duration=None):
+    """Wall-clock budget in seconds for a stage on a source of the given duration"""
+    from app import app
+    
+    fixed, per_second = STAGE_TIMEOUTS[stage]
+    if per_second and not duration:
+        duration = UNKNOWN_DURATION
+    return (fixed + per_second * (duration or 0)) * app.config['PROCESSING_TIMEOUT_SCALE']
+
+@functools.lru_cache(maxsize=None)
+def find_tool(name):
+    """Locate a helper executable on PATH once per process"""
+    return shutil.which(name)
+
+def scheduling_prefix(stage):
+    """nice/ionice wrapper for an encoder stage's command, so transcodes yield to the web tier"""
+    from app import app
+    
+    if stage not in ENCODER_STAGES:
+        return []
+    
+    prefix = []
+    nice = app.config['PROCESSING_NICE']
+    if nice and find_tool('nice'):
+        prefix += ['nice', '-n', str(nice)]
+    ionice_class = app.config['PROCESSING_IONICE_CLASS']
+    if ionice_class and find_tool('ionice'):
+        prefix += ['ionice', '-c', IONICE_CLASSES.get(ionice_class, ionice_class)]
+    return prefix
+
+def get_encoder_cgroup():
+    """Return the cgroup v2 directory encoders run in, applying PROCESSING_CPU_QUOTA on first use
+    
+    Needs a delegated cgroup this process may write to (PROCESSING_CGROUP);
+    returns None when none is configured or it can't be used.
+    """
+    global encoder_cgroup
+    from app import app
+    
+    with encoder_cgroup_lock:
+        if encoder_cgroup is None:
+            encoder_cgroup = False
+            path = app.config['PROCESSING_CGROUP']
+            quota = app.config['PROCESSING_CPU_QUOTA']
+            if path:
+                try:
+                    if quota > 0:
+                        with open(os.path.join(path, 'cpu.max'), 'w') as f:
+                            f.write(f"{int(quota * CGROUP_CPU_PERIOD)} {CGROUP_CPU_PERIOD}")
+                    if not os.access(os.path.join(path, 'cgroup.procs'), os.W_OK):
+                        raise PermissionError(f"cannot write {path}/cgroup.procs")
+                    encoder_cgroup = path
+                    logger.info(f"Encoders run in cgroup {path} (CPU quota: {quota or 'none'})")
+                except OSError as e:
+                    logger.warning(f"Cannot use cgroup {path} for encoders, running without a CPU quota: {e}")
+        return encoder_cgroup or None
+
+def join_encoder_cgroup(process, stage):
+    """Move an encoder process into the encoder cgroup, if one is in use"""
+    if stage not in ENCODER_STAGES:
+        return
+    cgroup = get_encoder_cgroup()
+    if cgroup is None:
+        return
+    try:
+        with open(os.path.join(cgroup, 'cgroup.procs'), 'w') as f:
+            f.write(str(process.pid))
+    except OSError as e:
+        # The process may already have exited
+        logger.debug(f"Could not move pid {process.pid} into {cgroup}: {e}")
+
+@contextmanager
+def managed_process(cmd, stage, duration=None, **popen_kwargs):
+    """Start a subprocess in its own process group, registered to the current job and killed when over budget
+    
+    Raises subprocess.TimeoutExpired when the stage ran out of time and
+    JobCancelled when the job was cancelled while the process ran.
+    """
+    video_id = current_video_id()
+    timeout = stage_timeout(stage, duration)
+    
+    with registry_lock:
+        if video_id in cancelled_jobs:
+            raise JobCancelled(video_id)
+        process = subprocess.Popen(scheduling_prefix(stage) + cmd, start_new_session=True, **popen_kwargs)
+        job_processes.setdefault(video_id, set()).add(process)
+    join_encoder_cgroup(process, stage)
+    
+    timed_out = threading.Event()
+    
+    def on_timeout():
+        logger.warning(f"{stage} stage exceeded its {timeout:.0f}s budget, killing {cmd[0]} (pid {process.pid})")
+        timed_out.set()
+        kill_process_group(process)
+    
+    timer = threading.Timer(timeout, on_timeout)
+    timer.daemon = True
+    timer.start()
+    
+    try:
+        yield process
+    finally:
+        timer.cancel()
+        if process.poll() is None:
+            kill_process_group(process)
+        process.wait()
+        with registry_lock:
+            processes = job_processes.get(video_id)
+            processes.discard(process)
+            if not processes:
+                del job_processes[video_id]
+    
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    raise_if_cancelled(video_id)
+
+def run_process(cmd, stage, duration=None):
+    """Run a command to completion like subprocess.run(capture_output=True, text=True), within the stage budget"""
+    with managed_process(cmd, stage, duration, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
+        stdout, stderr = process.communicate()
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+def is_transient_error(error):
+    """Classify an exception, or an error message, as transient (retry later) or permanent"""
+    if isinstance(error, (TransientError, subprocess.TimeoutExpired, OperationalError)):
+        return True
+    if isinstance(error, OSError) and error.errno in TRANSIENT_ERRNOS:
+        return True
+    return bool(TRANSIENT_ERROR_PATTERN.search(str(error or '')))
+
+def retry_delay(attempts):
+    """Seconds to wait before retry number `attempts`: exponential backoff with jitter"""
+    from app import app
+    
+    delay = min(app.config['RETRY_MAX_DELAY'], app.config['RETRY_BASE_DELAY'] * 2 ** max(0, attempts - 1))
+    
+    # Half fixed, half random, so a burst of failures doesn't come back all at once
+    return delay / 2 + random.uniform(0, delay / 2)
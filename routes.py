@@ -1,13 +1,17 @@
 import os
 import json
 import uuid
+import base64
+import hashlib
 import datetime
+import shutil
 import logging
 from flask import request, render_template, redirect, url_for, jsonify, flash, send_from_directory
 from werkzeug.utils import secure_filename
+from sqlalchemy import or_, and_
 from app import db, csrf
-from models import User, Video, ProcessingQueue
-from downloader import validate_url, queue_download
+from models import User, Video, ProcessingQueue, UploadSession, UploadChunk, WorkerNode
+from downloader import validate_url, canonicalize_url, queue_download
 import video_processor
 from forms import LoginForm, RegistrationForm
 from flask_login import login_user, logout_user, current_user, login_required
@@ -20,6 +24,44 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in {"mp4", "mov", "avi", "mkv", "webm", "flv", "wmv"}
 
+# tus protocol version advertised by the resumable upload endpoints
+TUS_VERSION = '1.0.0'
+
+# Block size used when streaming request bodies to disk
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+# Seconds after which a finalize that never completed (its process died) may be retaken
+FINALIZE_TIMEOUT = 300
+
+def parse_upload_metadata(header):
+    """Parse a tus Upload-Metadata header ("key base64value,key base64value") into a dict"""
+    metadata = {}
+    for pair in (header or '').split(','):
+        parts = pair.strip().split(' ', 1)
+        if not parts[0]:
+            continue
+        try:
+            metadata[parts[0]] = base64.b64decode(parts[1]).decode('utf-8') if len(parts) > 1 else ''
+        except (ValueError, UnicodeDecodeError):
+            metadata[parts[0]] = ''
+    return metadata
+
+def tus_headers(upload=None):
+    """Common response headers for the resumable upload endpoints"""
+    headers = {
+        'Tus-Resumable': TUS_VERSION,
+        'Cache-Control': 'no-store'
+    }
+    if upload is not None:
+        headers['Upload-Offset'] = str(upload.received_offset())
+        headers['Upload-Length'] = str(upload.upload_length)
+    return headers
+
+def asset_in_use(video, column):
+    """Check whether another video still references the same file (deduplicated uploads share files)"""
+    value = getattr(video, column)
+    return Video.query.filter(getattr(Video, column) == value, Video.id != video.id).count() > 0
+
 def register_routes(app):
     """Register all routes with the Flask app"""
     
@@ -42,6 +84,43 @@ def register_routes(app):
             return render_template('dashboard.html', videos=videos)
         return redirect(url_for('login'))
     
+    @app.route('/admin/workers')
+    @login_required
+    def worker_fleet():
+        """Admin view of the processing worker fleet and its utilization"""
+        if not current_user.is_admin:
+            flash('Only administrators can view the worker fleet.', 'danger')
+            return redirect(url_for('dashboard'))
+        
+        lease_seconds = app.config['PROCESSING_LEASE_SECONDS']
+        running = ProcessingQueue.query.filter_by(status='processing').all()
+        
+        nodes = []
+        for node in WorkerNode.query.order_by(WorkerNode.hostname, WorkerNode.started_at).all():
+            # Jobs are attributed through worker_id (host:pid:token:thread), which is live, unlike the heartbeat's count
+            jobs = [job for job in running if job.worker_id and job.worker_id.startswith(f"{node.id}:")]
+            nodes.append({'node': node, 'jobs': jobs, 'online': node.is_online(lease_seconds)})
+        
+        # Encode slots and yt-dlp slots are counted apart, utilization is the encode side's
+        for entry in nodes:
+            entry['processing'] = [job for job in entry['jobs'] if job.stage != 'download']
+            entry['downloads'] = [job for job in entry['jobs'] if job.stage == 'download']
+        
+        online = [entry for entry in nodes if entry['online']]
+        capacity = sum(entry['node'].capacity for entry in online)
+        busy = sum(len(entry['processing']) for entry in online)
+        fleet = {
+            'nodes': len(online),
+            'capacity': capacity,
+            'busy': busy,
+            'utilization': round(100 * busy / capacity) if capacity else 0,
+            'download_capacity': sum(entry['node'].download_capacity for entry in online),
+            'downloading': sum(len(entry['downloads']) for entry in online),
+            'queued': ProcessingQueue.query.filter_by(status='queued', stage='process').count(),
+            'queued_downloads': ProcessingQueue.query.filter_by(status='queued', stage='download').count()
+        }
+        return render_template('workers.html', nodes=nodes, fleet=fleet)
+    
     @app.route('/api/upload', methods=['POST'])
     @csrf.exempt
     def upload_file():
@@ -66,9 +145,13 @@ def register_routes(app):
             filename = f"{uuid.uuid4().hex}_{original_filename}"
             file_path = os.path.join(upload_dir, filename)
             
-            # Save the file
+            # Save the file, hashing it on the way to disk for deduplication
+            sha256 = hashlib.sha256()
             try:
-                file.save(file_path)
+                with open(file_path, 'wb') as f:
+                    for block in iter(lambda: file.stream.read(STREAM_BLOCK_SIZE), b''):
+                        sha256.update(block)
+                        f.write(block)
                 
                 # Verify file saved correctly
                 if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
@@ -84,6 +167,7 @@ def register_routes(app):
             video = Video(
                 title=title,
                 original_path=file_path,
+                content_hash=sha256.hexdigest(),
                 source_type='upload',
                 status='pending',
                 user_id=current_user.id if current_user.is_authenticated else None
@@ -91,15 +175,11 @@ def register_routes(app):
             db.session.add(video)
             db.session.commit()
             
-            # Add to processing queue
-            queue_item = ProcessingQueue(video_id=video.id, priority=1)
-            db.session.add(queue_item)
-            db.session.commit()
-            
-            # Start processing
-            video_processor.process_next()
+            # Add to processing queue (or link to an identical video's outputs) - the request returns now
+            video_processor.enqueue_video(video, priority=1)
             
             return jsonify({
+                'success': True,
                 'message': 'Video uploaded successfully',
                 'slug': video.slug,
                 'redirect': url_for('view_video', slug=video.slug)
@@ -109,6 +189,196 @@ def register_routes(app):
             logger.error(f"Unexpected error in upload_file: {e}")
             return jsonify({'error': 'Server error occurred during upload'}), 500
     
+    def get_upload_session(upload_id):
+        """Look up a resumable upload and check the current user may write to it"""
+        upload = UploadSession.query.get_or_404(upload_id)
+        if upload.user_id is not None:
+            if not current_user.is_authenticated or (current_user.id != upload.user_id and not current_user.is_admin):
+                return None
+        return upload
+    
+    @app.route('/api/uploads', methods=['POST'])
+    @csrf.exempt
+    def create_upload():
+        """Start a resumable chunked upload (tus-style creation)"""
+        try:
+            upload_length = int(request.headers.get('Upload-Length', ''))
+        except ValueError:
+            return jsonify({'error': 'Upload-Length header is required'}), 400, tus_headers()
+        
+        if upload_length <= 0:
+            return jsonify({'error': 'Upload-Length must be positive'}), 400, tus_headers()
+        if upload_length > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({'error': 'File is too large'}), 413, tus_headers()
+        
+        metadata = parse_upload_metadata(request.headers.get('Upload-Metadata'))
+        original_filename = secure_filename(metadata.get('filename', ''))
+        if not original_filename or not allowed_file(original_filename):
+            return jsonify({'error': 'File type not allowed. Supported formats: MP4, MOV, AVI, MKV, WEBM, FLV, WMV'}), 400, tus_headers()
+        
+        upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'original')
+        os.makedirs(upload_dir, exist_ok=True)
+        
+        upload = UploadSession(
+            id=uuid.uuid4().hex,
+            filename=original_filename,
+            upload_length=upload_length,
+            user_id=current_user.id if current_user.is_authenticated else None
+        )
+        upload.file_path = os.path.join(upload_dir, f"{upload.id}.part")
+        
+        # Pre-size the file so chunks can be written at any offset, in any order
+        try:
+            with open(upload.file_path, 'wb') as f:
+                f.truncate(upload_length)
+        except Exception as e:
+            logger.error(f"Error creating upload file: {e}")
+            return jsonify({'error': f'Error creating upload: {str(e)}'}), 500, tus_headers()
+        
+        db.session.add(upload)
+        db.session.commit()
+        
+        location = url_for('upload_status', upload_id=upload.id)
+        headers = tus_headers(upload)
+        headers['Location'] = location
+        return jsonify({'id': upload.id, 'location': location, 'offset': 0}), 201, headers
+    
+    @app.route('/api/uploads/<upload_id>', methods=['HEAD', 'GET'])
+    @csrf.exempt
+    def upload_status(upload_id):
+        """Report how much of a resumable upload has been received"""
+        upload = get_upload_session(upload_id)
+        if upload is None:
+            return jsonify({'error': 'Unauthorized'}), 403, tus_headers()
+        
+        if request.method == 'HEAD':
+            return '', 200, tus_headers(upload)
+        
+        # GET also lists every received range so parallel clients can resume just the gaps
+        return jsonify({
+            'id': upload.id,
+            'offset': upload.received_offset(),
+            'length': upload.upload_length,
+            'ranges': upload.received_ranges(),
+            'status': upload.status
+        }), 200, tus_headers(upload)
+    
+    @app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+    @csrf.exempt
+    def upload_chunk(upload_id):
+        """Write one chunk of a resumable upload at its Upload-Offset"""
+        upload = get_upload_session(upload_id)
+        if upload is None:
+            return jsonify({'error': 'Unauthorized'}), 403, tus_headers()
+        if upload.status != 'uploading':
+            return jsonify({'error': 'Upload already finalized'}), 409, tus_headers(upload)
+        
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return jsonify({'error': 'Upload-Offset header is required'}), 400, tus_headers(upload)
+        
+        length = request.content_length
+        if length is None:
+            return jsonify({'error': 'Content-Length header is required'}), 411, tus_headers(upload)
+        if offset < 0 or offset + length > upload.upload_length:
+            return jsonify({'error': 'Chunk is outside the upload'}), 400, tus_headers(upload)
+        
+        # Stream the body straight into place - nothing is spooled to a temp file first
+        written = 0
+        try:
+            with open(upload.file_path, 'r+b') as f:
+                f.seek(offset)
+                while written < length:
+                    block = request.stream.read(min(STREAM_BLOCK_SIZE, length - written))
+                    if not block:
+                        break
+                    f.write(block)
+                    written += len(block)
+        except Exception as e:
+            logger.error(f"Error writing chunk for upload {upload.id}: {e}")
+            return jsonify({'error': f'Error saving chunk: {str(e)}'}), 500, tus_headers(upload)
+        
+        # Only the bytes that actually arrived count, so an interrupted chunk can be resumed
+        if written > 0:
+            db.session.add(UploadChunk(upload_id=upload.id, offset=offset, length=written))
+            db.session.commit()
+            db.session.refresh(upload)
+        
+        if written < length:
+            return jsonify({'error': 'Chunk was interrupted'}), 400, tus_headers(upload)
+        
+        return '', 204, tus_headers(upload)
+    
+    @app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+    @csrf.exempt
+    def finalize_upload(upload_id):
+        """Turn a fully received resumable upload into a video and queue it for processing"""
+        upload = get_upload_session(upload_id)
+        if upload is None:
+            return jsonify({'error': 'Unauthorized'}), 403, tus_headers()
+        
+        if upload.status == 'completed' and upload.video_id:
+            video = Video.query.get(upload.video_id)
+        else:
+            if upload.received_offset() < upload.upload_length:
+                return jsonify({
+                    'error': 'Upload is incomplete',
+                    'ranges': upload.received_ranges()
+                }), 409, tus_headers(upload)
+            
+            # Only one finalize request may win, even across gunicorn workers; one left
+            # 'finalizing' by a process that died is retaken after FINALIZE_TIMEOUT
+            now = datetime.datetime.utcnow()
+            claimed = UploadSession.query.filter(
+                UploadSession.id == upload.id,
+                or_(UploadSession.status == 'uploading',
+                    and_(UploadSession.status == 'finalizing',
+                         UploadSession.updated_at < now - datetime.timedelta(seconds=FINALIZE_TIMEOUT)))
+            ).update({'status': 'finalizing', 'updated_at': now}, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                return jsonify({'error': 'Upload is already being finalized'}), 409, tus_headers()
+            db.session.refresh(upload)
+            
+            # Move the finished file to its permanent name (a retaken finalize may find it moved already)
+            file_path = upload.final_path()
+            if not os.path.exists(file_path):
+                try:
+                    os.replace(upload.file_path, file_path)
+                except Exception as e:
+                    logger.error(f"Error finalizing upload {upload.id}: {e}")
+                    upload.status = 'uploading'
+                    db.session.commit()
+                    return jsonify({'error': f'Error saving file: {str(e)}'}), 500, tus_headers(upload)
+            
+            # The processing worker hashes the file, so finalizing doesn't re-read up to MAX_CONTENT_LENGTH bytes
+            title = upload.filename.rsplit('.', 1)[0] if '.' in upload.filename else upload.filename
+            video = Video(
+                title=title,
+                original_path=file_path,
+                source_type='upload',
+                status='pending',
+                user_id=upload.user_id
+            )
+            db.session.add(video)
+            db.session.flush()
+            
+            upload.status = 'completed'
+            upload.file_path = file_path
+            upload.video_id = video.id
+            
+            # Queued in the same commit as the video and the completed session, so a finalize
+            # that dies before it leaves neither behind and can simply be retaken
+            video_processor.enqueue_video(video, priority=1)
+        
+        return jsonify({
+            'success': True,
+            'message': 'Video uploaded successfully',
+            'slug': video.slug,
+            'redirect': url_for('view_video', slug=video.slug)
+        }), 200, tus_headers(upload)
+    
     @app.route('/api/download', methods=['POST'])
     @csrf.exempt
     def download_video():
@@ -131,9 +401,16 @@ def register_routes(app):
             if not validate_url(url):
                 return jsonify({'error': 'Invalid or unsupported URL'}), 400
             
+            # Earlier downloads of the same link are found by the canonical URL, the submitted one is downloaded
+            try:
+                canonical_url = canonicalize_url(url)
+            except ValueError:
+                return jsonify({'error': 'Invalid or unsupported URL'}), 400
+            
             # Create video entry in database
             video = Video(
                 source_url=url,
+                canonical_url=canonical_url,
                 source_type='link',
                 status='downloading',
                 user_id=current_user.id if current_user.is_authenticated else None
@@ -141,11 +418,11 @@ def register_routes(app):
             db.session.add(video)
             db.session.commit()
             
-            # Queue download in background
-            queue_download(video.id, url)
+            # Queue the download for a download worker, or reuse an earlier download of the link
+            queue_download(video)
             
             return jsonify({
-                'message': 'Download queued successfully',
+                'message': 'Video already available' if video.status == 'completed' else 'Download queued successfully',
                 'slug': video.slug,
                 'redirect': url_for('dashboard')
             }), 200
@@ -204,13 +481,20 @@ def register_routes(app):
         if not current_user.is_admin and video.user_id != current_user.id:
             return jsonify({'error': 'Unauthorized'}), 403
         
+        # Stop an in-flight download or transcode before its files are removed
+        video_processor.cancel_job(video.id)
+        
         # Delete associated files - improved error handling
         try:
             # Make sure we have the correct paths within the upload folder
             upload_folder = app.config['UPLOAD_FOLDER']
             
+            # Files shared with identical videos are reference counted by the rows that use them
+            
             # Delete original file
-            if video.original_path:
+            if video.original_path and asset_in_use(video, 'original_path'):
+                logger.info(f"Keeping original file still used by other videos: {video.original_path}")
+            elif video.original_path:
                 # Get filename only
                 original_filename = os.path.basename(video.original_path)
                 original_path = os.path.join(upload_folder, 'original', original_filename)
@@ -224,7 +508,9 @@ def register_routes(app):
                     logger.warning(f"Could not find original file: {video.original_path}")
             
             # Delete processed file
-            if video.processed_path:
+            if video.processed_path and asset_in_use(video, 'processed_path'):
+                logger.info(f"Keeping processed file still used by other videos: {video.processed_path}")
+            elif video.processed_path:
                 processed_filename = os.path.basename(video.processed_path)
                 processed_path = os.path.join(upload_folder, 'processed', processed_filename)
                 if os.path.exists(processed_path):
@@ -237,7 +523,9 @@ def register_routes(app):
                     logger.warning(f"Could not find processed file: {video.processed_path}")
             
             # Delete thumbnail file
-            if video.thumbnail_path:
+            if video.thumbnail_path and asset_in_use(video, 'thumbnail_path'):
+                logger.info(f"Keeping thumbnail file still used by other videos: {video.thumbnail_path}")
+            elif video.thumbnail_path:
                 thumbnail_filename = os.path.basename(video.thumbnail_path)
                 thumbnail_path = os.path.join(upload_folder, 'thumbnails', thumbnail_filename)
                 if os.path.exists(thumbnail_path):
@@ -250,7 +538,9 @@ def register_routes(app):
                     logger.warning(f"Could not find thumbnail file: {video.thumbnail_path}")
             
             # Delete HLS files if they exist
-            if video.hls_path:
+            if video.hls_path and asset_in_use(video, 'hls_path'):
+                logger.info(f"Keeping HLS files still used by other videos: {video.hls_path}")
+            elif video.hls_path:
                 # Try both potential HLS directory paths
                 hls_dir = os.path.dirname(video.hls_path)
                 hls_slug = os.path.basename(hls_dir)
@@ -258,22 +548,18 @@ def register_routes(app):
                 
                 # Try stored path first
                 if os.path.exists(hls_dir) and os.path.isdir(hls_dir):
-                    for file in os.listdir(hls_dir):
-                        file_path = os.path.join(hls_dir, file)
-                        if os.path.isfile(file_path):
-                            os.remove(file_path)
-                    os.rmdir(hls_dir)
+                    shutil.rmtree(hls_dir)  # Includes the per-rendition subdirectories
                     logger.info(f"Deleted HLS directory: {hls_dir}")
                 # Try alternative path
                 elif os.path.exists(alt_hls_dir) and os.path.isdir(alt_hls_dir):
-                    for file in os.listdir(alt_hls_dir):
-                        file_path = os.path.join(alt_hls_dir, file)
-                        if os.path.isfile(file_path):
-                            os.remove(file_path)
-                    os.rmdir(alt_hls_dir)
+                    shutil.rmtree(alt_hls_dir)  # Includes the per-rendition subdirectories
                     logger.info(f"Deleted HLS directory: {alt_hls_dir}")
                 else:
                     logger.warning(f"Could not find HLS directory: {hls_dir} or {alt_hls_dir}")
+            
+            # Unfinished videos may have outputs that were never recorded on the row
+            if video.status != 'completed':
+                video_processor.remove_partial_outputs(video.slug, upload_folder)
         except Exception as e:
             logger.error(f"Error deleting files for video {video.slug}: {str(e)}")
             # Continue with database deletion even if file deletion fails
@@ -352,6 +352,7 @@ document.addEventListener('DOMContentLoaded', function() {
                             <strong>Processing your video...</strong>
                             <div class="spinner-border ms-auto" role="status" aria-hidden="true"></div>
                         </div>
+                        ${formatProgress(video)}
                     </div>
                 `;
                 break;
@@ -368,6 +369,28 @@ document.addEventListener('DOMContentLoaded', function() {
         videoStatus.innerHTML = statusHtml;
     }
     
+    // Helper function to render encode progress, speed and ETA for a processing video
+    function formatProgress(video) {
+        if (video.progress === undefined || video.progress === null) return '';
+        
+        const percent = Math.round(video.progress);
+        const details = [`${percent}%`];
+        if (video.encode_speed) {
+            details.push(`${video.encode_speed.toFixed(1)}x realtime`);
+        }
+        if (video.eta_seconds !== undefined && video.eta_seconds !== null) {
+            const eta = Math.max(0, Math.round(video.eta_seconds));
+            details.push(eta >= 60 ? `about ${Math.floor(eta / 60)}m ${eta % 60}s left` : `about ${eta}s left`);
+        }
+        
+        return `
+            <div class="progress mt-2" style="height: 8px;">
+                <div class="progress-bar" role="progressbar" style="width: ${percent}%" aria-valuenow="${percent}" aria-valuemin="0" aria-valuemax="100"></div>
+            </div>
+            <small class="text-muted">${details.join(' &middot; ')}</small>
+        `;
+    }
+        
     // Helper function to show alerts with duplicate prevention
     function showAlert(message, type) {
         const alertsContainer = document.getElementById('alerts-container');
@@ -407,3 +430,118 @@ document.addEventListener('DOMContentLoaded', function() {
         }, 5000);
     }
 });
+
+// Resumable chunked uploads (tus-style) for large files
+const RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024;  // 8MB per PATCH
+const RESUMABLE_PARALLEL_CHUNKS = 3;           // Chunks in flight at once
+const RESUMABLE_MAX_RETRIES = 5;               // Attempts per chunk before giving up
+
+// Upload a file through /api/uploads, resuming a previous attempt for the same file if possible.
+// onProgress(uploadedBytes, totalBytes) is called as chunks complete; resolves with the
+// same JSON that /api/upload returns (slug, redirect).
+async function uploadFileResumable(file, onProgress) {
+    const tusHeaders = { 'Tus-Resumable': '1.0.0' };
+    const storageKey = `resumable-upload:${file.name}:${file.size}:${file.lastModified}`;
+    let uploadUrl = localStorage.getItem(storageKey);
+    let receivedRanges = [];
+    
+    // Ask the server which byte ranges it already has from an earlier attempt
+    if (uploadUrl) {
+        try {
+            const response = await fetch(uploadUrl, { headers: tusHeaders });
+            const data = await response.json();
+            if (response.ok && data.status === 'uploading') {
+                receivedRanges = data.ranges;
+            } else {
+                uploadUrl = null;
+            }
+        } catch (e) {
+            uploadUrl = null;
+        }
+    }
+    
+    // Otherwise start a new upload
+    if (!uploadUrl) {
+        const encodedName = btoa(String.fromCharCode(...new TextEncoder().encode(file.name)));
+        const response = await fetch('/api/uploads', {
+            method: 'POST',
+            headers: {
+                ...tusHeaders,
+                'Upload-Length': String(file.size),
+                'Upload-Metadata': `filename ${encodedName}`
+            }
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Could not start upload');
+        }
+        uploadUrl = data.location;
+        localStorage.setItem(storageKey, uploadUrl);
+    }
+    
+    // Work out which chunks are still missing
+    const chunks = [];
+    for (let start = 0; start < file.size; start += RESUMABLE_CHUNK_SIZE) {
+        const end = Math.min(start + RESUMABLE_CHUNK_SIZE, file.size);
+        const received = receivedRanges.some(([from, to]) => from <= start && to >= end);
+        if (!received) {
+            chunks.push([start, end]);
+        }
+    }
+    
+    let uploadedBytes = file.size - chunks.reduce((total, [start, end]) => total + (end - start), 0);
+    onProgress(uploadedBytes, file.size);
+    
+    // Send one chunk, retrying with exponential backoff on network or server errors
+    async function sendChunk(start, end) {
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await fetch(uploadUrl, {
+                    method: 'PATCH',
+                    headers: {
+                        ...tusHeaders,
+                        'Upload-Offset': String(start),
+                        'Content-Type': 'application/offset+octet-stream'
+                    },
+                    body: file.slice(start, end)
+                });
+                if (response.ok) {
+                    return;
+                }
+                if (response.status === 403 || response.status === 404 || response.status === 409) {
+                    const data = await response.json().catch(() => ({}));
+                    throw Object.assign(new Error(data.error || 'Upload rejected'), { fatal: true });
+                }
+            } catch (e) {
+                if (e.fatal || attempt >= RESUMABLE_MAX_RETRIES) {
+                    throw e;
+                }
+            }
+            if (attempt >= RESUMABLE_MAX_RETRIES) {
+                throw new Error('Upload failed after several retries');
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000 * Math.pow(2, attempt - 1)));
+        }
+    }
+    
+    // Upload missing chunks with a few requests in flight at once
+    let nextChunk = 0;
+    async function chunkWorker() {
+        while (nextChunk < chunks.length) {
+            const [start, end] = chunks[nextChunk++];
+            await sendChunk(start, end);
+            uploadedBytes += end - start;
+            onProgress(uploadedBytes, file.size);
+        }
+    }
+    await Promise.all(Array.from({ length: RESUMABLE_PARALLEL_CHUNKS }, chunkWorker));
+    
+    // Every byte is on the server - turn the upload into a video
+    const response = await fetch(`${uploadUrl}/finalize`, { method: 'POST', headers: tusHeaders });
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || 'Upload failed');
+    }
+    localStorage.removeItem(storageKey);
+    return data;
+}
@@ -375,6 +375,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 nudgeMaxRetry: 5, // Maximum amount of nudge retries allowed for a simple buffer stall
                 startFragPrefetch: true, // Start prefetching the first fragment
                 abrEwmaDefaultEstimate: 500000, // Default bandwidth estimate (500kbps)
+                capLevelToPlayerSize: true, // Don't pick renditions larger than the player on screen
                 testBandwidth: true // Test the available bandwidth before loading segments
             });
             
@@ -1,139 +1,885 @@
 import os
 import time
+import select
+import socket
 import logging
 import threading
 import subprocess
 import json
-from datetime import datetime
+import glob
+import hashlib
+import tempfile
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION, FIRST_COMPLETED
+from datetime import datetime, timedelta
 import shutil
+from sqlalchemy import text, func, or_
 from app import db
-from models import Video, ProcessingQueue
+from models import Video, ProcessingQueue, WorkerNode, UploadSession, UploadChunk
+from process_runner import (job_scope, current_video_id, cancel_job, is_cancelled, raise_if_cancelled, managed_process,
+                            run_process, JobCancelled, is_transient_error, retry_delay)
 
 # Setup logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Video processing thread and control flag
-processing_thread = None
-should_stop = False
-processing_lock = threading.Lock()
+# Parsed ffprobe output keyed by path, size and mtime (see probe_video)
+PROBE_CACHE_SIZE = 256
+probe_cache = OrderedDict()
+probe_cache_lock = threading.Lock()
 
-def init_processor():
-    """Initialize the video processor"""
-    global processing_thread, should_stop
+# Minimum seconds between progress writes to the database for a running job
+PROGRESS_UPDATE_INTERVAL = 2
+
+# HLS ladder bitrates per rendition height: (video kbit/s cap, audio kbit/s)
+HLS_LADDER_BITRATES = {
+    2160: (16000, 192),
+    1440: (9000, 192),
+    1080: (5000, 128),
+    720: (2800, 128),
+    480: (1400, 96),
+    360: (800, 96),
+    240: (400, 64),
+}
+
+# H.264 levels: (level_idc, max macroblocks/s, max frame size in macroblocks, max Main profile kbit/s)
+H264_LEVELS = [
+    (30, 40500, 1620, 10000),
+    (31, 108000, 3600, 14000),
+    (32, 216000, 5120, 20000),
+    (40, 245760, 8192, 20000),
+    (41, 245760, 8192, 50000),
+    (42, 522240, 8704, 50000),
+    (50, 589824, 22080, 135000),
+    (51, 983040, 36864, 240000),
+    (52, 2073600, 36864, 240000),
+]
+
+# RFC 6381 codec prefixes for stream-copied renditions
+H264_PROFILE_CODECS = {'Constrained Baseline': '42E0', 'Baseline': '4200', 'Main': '4D40', 'High': '6400'}
+AAC_PROFILE_CODECS = {'LC': 'mp4a.40.2', 'HE-AAC': 'mp4a.40.5', 'HE-AACv2': 'mp4a.40.29'}
+
+# Video processing and download worker pools and control flag
+processing_threads = []
+download_threads = []
+stop_event = threading.Event()
+
+# Queue wakeup signalling - enqueues bump the generation and wake idle workers
+QUEUE_NOTIFY_CHANNEL = 'processing_queue'
+queue_condition = threading.Condition()
+queue_generation = 0
+queue_listener_thread = None
+
+# Jobs running in this process (queue item id -> (worker id, video id, stage)), whose leases the heartbeat renews
+running_jobs = {}
+running_jobs_lock = threading.Lock()
+heartbeat_thread = None
+
+# File in each job's scratch directory naming the worker node (host:pid:token) that owns it
+SCRATCH_OWNER_FILE = '.owner'
+
+# Random per process, so a restarted container worker that gets the same hostname and PID 1 is a new node
+PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+# Leases a silent worker node stays listed in the fleet view before it is pruned
+WORKER_NODE_RETENTION_LEASES = 30
+
+def init_processor(concurrency=None, download_concurrency=None):
+    """Initialize the video processor and download worker pools (one thread per concurrent job)"""
+    global processing_threads, download_threads
+    from app import app
+    
+    if concurrency is None:
+        concurrency = app.config.get("CONCURRENT_PROCESSING", 1)
+    concurrency = max(1, int(concurrency))
+    if download_concurrency is None:
+        download_concurrency = app.config.get("DOWNLOAD_CONCURRENCY", 2)
+    download_concurrency = max(0, int(download_concurrency))
+    
+    stop_event.clear()
+    
+    # Drop workers that have exited and top the pools back up to the requested size
+    processing_threads = start_workers(processing_threads, concurrency, process_next, 'video-processor')
+    download_threads = start_workers(download_threads, download_concurrency, download_next, 'video-downloader')
     
-    should_stop = False
+    # On Postgres, LISTEN for enqueues made by other processes
+    start_queue_listener()
     
-    if processing_thread is None or not processing_thread.is_alive():
-        processing_thread = threading.Thread(target=processor_worker)
-        processing_thread.daemon = True
-        processing_thread.start()
-        logger.info("Video processor initialized")
+    # Renew the leases of running jobs and requeue jobs abandoned by dead workers
+    start_heartbeat()
+    
+    logger.info(f"Video processor initialized with {len(processing_threads)} worker(s) "
+                f"and {len(download_threads)} download worker(s)")
+
+def start_workers(threads, size, run_next, name):
+    """Top a worker pool back up to `size` live threads, each draining one stage of the queue"""
+    threads = [thread for thread in threads if thread.is_alive()]
+    while len(threads) < size:
+        thread = threading.Thread(target=processor_worker, args=(run_next,), name=f"{name}-{len(threads)}")
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
 
-def stop_processor():
-    """Stop the video processor thread"""
-    global should_stop
-    should_stop = True
+def stop_processor(timeout=None):
+    """Stop the video processor workers, waiting for in-flight jobs to finish"""
+    stop_event.set()
+    wake_workers()
     logger.info("Video processor stopping...")
+    
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    for thread in processing_threads + download_threads:
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        thread.join(remaining)
+    
+    still_running = [thread.name for thread in processing_threads + download_threads if thread.is_alive()]
+    if still_running:
+        logger.warning(f"Video processor workers still running after stop: {still_running}")
+        return False
+    
+    logger.info("Video processor stopped")
+    return True
 
-def processor_worker():
-    """Background worker that processes videos in the queue"""
-    global should_stop
+def requeue_running_jobs():
+    """Cancel the jobs running in this process so their workers hand them back to the queue
     
-    logger.info("Video processor worker started")
+    Only takes effect while the processor is stopping, for a shutdown that
+    can't wait for long encodes to finish.
+    """
+    from app import app
     
-    while not should_stop:
+    with running_jobs_lock:
+        video_ids = [video_id for worker_id, video_id, stage in running_jobs.values()]
+    
+    for video_id in video_ids:
+        cancel_job(video_id)
+    return len(video_ids)
+
+def processor_worker(run_next=None):
+    """Background worker that drains one stage of the queue (processing by default)"""
+    from app import app
+    
+    logger.info(f"Video processor worker {threading.current_thread().name} started")
+    
+    while not stop_event.is_set():
+        # Remember the queue generation so an enqueue that races with the check isn't missed
+        seen_generation = queue_generation
+        
         # Check if there are any videos to process
-        processed_any = process_next()
+        try:
+            processed_any = (run_next or process_next)()
+        except Exception as e:
+            logger.exception(f"Error in video processor worker: {e}")
+            processed_any = False
         
-        # If nothing was processed, sleep for a bit
+        # If nothing was processed, wait for an enqueue, a retry coming due or the fallback poll interval
         if not processed_any:
-            time.sleep(5)
+            wait_for_work(seen_generation, seconds_until_next_retry(app.config['QUEUE_POLL_INTERVAL']))
     
-    logger.info("Video processor worker stopped")
+    logger.info(f"Video processor worker {threading.current_thread().name} stopped")
 
-def process_next():
-    """Process the next video in the queue"""
+def seconds_until_next_retry(default):
+    """Seconds until the earliest backed-off job becomes claimable, at most `default`"""
     from app import app
     
-    with app.app_context():
-        # Find the next queued video with highest priority
-        with processing_lock:
-            queue_item = ProcessingQueue.query.filter_by(status='queued').order_by(
-                ProcessingQueue.priority.desc(),
-                ProcessingQueue.created_at.asc()
-            ).first()
-            
-            if not queue_item:
-                return False
+    try:
+        with app.app_context():
+            next_attempt_at = db.session.query(func.min(ProcessingQueue.next_attempt_at)).filter(
+                ProcessingQueue.status == 'queued',
+                ProcessingQueue.next_attempt_at > datetime.utcnow()
+            ).scalar()
+    except Exception as e:
+        logger.warning(f"Could not check for pending retries: {e}")
+        return default
+    
+    if next_attempt_at is None:
+        return default
+    return max(1, min(default, (next_attempt_at - datetime.utcnow()).total_seconds()))
+
+def wake_workers():
+    """Wake idle workers in this process so they check the queue immediately"""
+    global queue_generation
+    with queue_condition:
+        queue_generation += 1
+        queue_condition.notify_all()
+
+def wait_for_work(seen_generation, timeout):
+    """Block until the queue changes, the processor is stopped or `timeout` passes"""
+    with queue_condition:
+        queue_condition.wait_for(
+            lambda: queue_generation != seen_generation or stop_event.is_set(),
+            timeout
+        )
+
+def notify_queue():
+    """Signal that new work was queued, to this process and (on Postgres) every other one
+
+    Postgres delivers NOTIFY when the surrounding transaction commits, so this
+    commits the session; local workers are only woken once the row is visible.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_notify(:channel, '')"), {'channel': QUEUE_NOTIFY_CHANNEL})
+    db.session.commit()
+    wake_workers()
+
+def enqueue_video(video, priority=1):
+    """Add a video to the processing queue and wake a worker to pick it up
+
+    Byte-identical copies of an already processed video are linked to its outputs
+    instead of being queued; None is returned in that case.
+    """
+    source = find_completed_duplicate(video)
+    if source is not None:
+        link_to_existing_outputs(video, source)
+        db.session.commit()
+        return None
+    
+    queue_item = ProcessingQueue(video_id=video.id, priority=priority)
+    db.session.add(queue_item)
+    notify_queue()
+    return queue_item
+
+def enqueue_download(video, priority=1):
+    """Queue a link for download by a download worker, which queues it for processing once downloaded
+
+    Links that were already downloaded and processed are linked to those outputs
+    instead of being queued; None is returned in that case.
+    """
+    source = find_completed_link(video)
+    if source is not None:
+        video.title = source.title
+        video.description = source.description
+        link_to_existing_outputs(video, source)
+        db.session.commit()
+        return None
+    
+    queue_item = ProcessingQueue(video_id=video.id, stage='download', priority=priority)
+    db.session.add(queue_item)
+    notify_queue()
+    return queue_item
+
+def hash_file(path):
+    """Compute the SHA-256 of a file, reading it in blocks"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def find_completed_duplicate(video):
+    """Find an already processed video with the same content hash, if any"""
+    if not video.content_hash:
+        return None
+    
+    return Video.query.filter(
+        Video.content_hash == video.content_hash,
+        Video.id != video.id,
+        Video.status == 'completed',
+        Video.processed_path.isnot(None)
+    ).order_by(Video.id.asc()).first()
+
+def find_completed_link(video):
+    """Find an already processed video downloaded from the same canonical URL, if any"""
+    if not video.canonical_url:
+        return None
+    
+    return Video.query.filter(
+        Video.canonical_url == video.canonical_url,
+        Video.id != video.id,
+        Video.status == 'completed',
+        Video.processed_path.isnot(None)
+    ).order_by(Video.id.asc()).first()
+
+def link_to_existing_outputs(video, source):
+    """Point a video at another video's original, processed MP4, HLS and thumbnail files
+
+    The shared files are reference counted through the rows that point at them, so
+    deleting either video only removes a file once nothing else uses it.
+    """
+    logger.info(f"Video {video.id} is identical to video {source.id}, reusing its outputs")
+    
+    # Drop the duplicate copy of the original and share the existing one
+    if source.original_path and video.original_path != source.original_path and os.path.exists(source.original_path):
+        if video.original_path and os.path.exists(video.original_path):
+            os.remove(video.original_path)
+        video.original_path = source.original_path
+    
+    video.processed_path = source.processed_path
+    video.hls_path = source.hls_path
+    video.thumbnail_path = source.thumbnail_path
+    video.duration = source.duration
+    video.width = source.width
+    video.height = source.height
+    video.size = source.size
+    video.probe_key = source.probe_key
+    video.probe_data = source.probe_data
+    video.status = 'completed'
+    video.error = None
+
+def remove_partial_outputs(slug, upload_folder, keep_original=False):
+    """Remove whatever a cancelled or interrupted job wrote for a video
+
+    With keep_original the downloaded source is kept, for a job that is retried.
+    """
+    partial_paths = [
+        os.path.join(upload_folder, 'processed', f"{slug}.mp4"),
+        os.path.join(upload_folder, 'thumbnails', f"{slug}.jpg"),
+    ]
+    if not keep_original:
+        partial_paths += glob.glob(os.path.join(upload_folder, 'original', glob.escape(slug) + '.*'))  # yt-dlp downloads and .part files
+    
+    for path in partial_paths:
+        if os.path.exists(path):
+            os.remove(path)
+            logger.info(f"Removed partial output: {path}")
+    
+    # Copies and replaced outputs of an interrupted publish
+    for subdir in ('processed', 'thumbnails', 'hls'):
+        for pattern in (f".incoming-{glob.escape(slug)}*", f".replaced-{glob.escape(slug)}*"):
+            for leftover in glob.glob(os.path.join(upload_folder, subdir, pattern)):
+                shutil.rmtree(leftover, ignore_errors=True)
+    
+    hls_dir = os.path.join(upload_folder, 'hls', slug)
+    if os.path.isdir(hls_dir):
+        shutil.rmtree(hls_dir, ignore_errors=True)
+        logger.info(f"Removed partial HLS output: {hls_dir}")
+
+def start_queue_listener():
+    """Start the Postgres LISTEN thread that wakes workers on enqueues from other processes"""
+    global queue_listener_thread
+    
+    if db.engine.dialect.name != 'postgresql' or db.engine.dialect.driver != 'psycopg2':
+        return
+    if queue_listener_thread is not None and queue_listener_thread.is_alive():
+        return
+    
+    queue_listener_thread = threading.Thread(target=queue_listener, name="video-processor-listener")
+    queue_listener_thread.daemon = True
+    queue_listener_thread.start()
+
+def queue_listener():
+    """LISTEN on the queue channel and wake local workers for every notification"""
+    import psycopg2.extensions
+    from app import app
+    
+    while not stop_event.is_set():
+        connection = None
+        try:
+            with app.app_context():
+                connection = db.engine.raw_connection()
+            pg_connection = connection.driver_connection
+            pg_connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
             
-            # Mark as processing
-            queue_item.status = 'processing'
-            queue_item.started_at = datetime.utcnow()
+            cursor = pg_connection.cursor()
+            cursor.execute(f"LISTEN {QUEUE_NOTIFY_CHANNEL}")
+            logger.info(f"Listening for queue notifications on '{QUEUE_NOTIFY_CHANNEL}'")
             
-            video = Video.query.get(queue_item.video_id)
-            if video:
-                video.status = 'processing'
+            # Catch anything queued while the listener was (re)connecting
+            wake_workers()
             
-            db.session.commit()
+            while not stop_event.is_set():
+                if select.select([pg_connection], [], [], 5) == ([], [], []):
+                    continue
+                
+                pg_connection.poll()
+                if pg_connection.notifies:
+                    pg_connection.notifies.clear()
+                    wake_workers()
+        
+        except Exception as e:
+            logger.warning(f"Queue listener error, reconnecting: {e}")
+            stop_event.wait(5)
+        
+        finally:
+            if connection is not None:
+                try:
+                    # Don't hand a LISTENing autocommit connection back to the pool
+                    connection.invalidate()
+                except Exception:
+                    pass
+
+def start_heartbeat():
+    """Start the thread that renews this process's job leases and reaps expired ones"""
+    global heartbeat_thread
+    
+    if heartbeat_thread is not None and heartbeat_thread.is_alive():
+        return
+    
+    heartbeat_thread = threading.Thread(target=lease_heartbeat, name="video-processor-heartbeat")
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+
+def lease_heartbeat():
+    """Renew leases every quarter lease, until stopped and no job is left running"""
+    from app import app
+    
+    interval = max(1, app.config['PROCESSING_LEASE_SECONDS'] // 4)
+    
+    with app.app_context():
+        # Show up in the fleet view straight away, not one interval later
+        try:
+            update_worker_node({})
+        except Exception as e:
+            logger.warning(f"Could not register worker node: {e}")
+            db.session.rollback()
+        
+        while True:
+            # Keep renewing while in-flight jobs finish after a stop
+            if stop_event.is_set():
+                time.sleep(interval)
+            else:
+                stop_event.wait(interval)
+            
+            with running_jobs_lock:
+                jobs = dict(running_jobs)
+            if stop_event.is_set() and not jobs:
+                break
+            
+            try:
+                renew_leases(jobs)
+                update_worker_node(jobs)
+                if not stop_event.is_set():
+                    reap_expired_jobs()
+                    prune_worker_nodes()
+                    clean_abandoned_scratch()
+                    expire_upload_sessions()
+            except Exception as e:
+                logger.warning(f"Lease heartbeat failed: {e}")
+                db.session.rollback()
+        
+        try:
+            remove_worker_node()
+        except Exception as e:
+            logger.warning(f"Could not unregister worker node: {e}")
+            db.session.rollback()
+
+def update_worker_node(jobs):
+    """Upsert this process's row in the worker registry with its capacity and load, per stage"""
+    node_id = get_node_id()
+    node = WorkerNode.query.get(node_id)
+    if node is None:
+        node = WorkerNode(id=node_id, hostname=socket.gethostname(), pid=os.getpid())
+        db.session.add(node)
+    
+    # A stopping node finishes its jobs but takes no new ones
+    stopping = stop_event.is_set()
+    node.capacity = 0 if stopping else sum(thread.is_alive() for thread in processing_threads)
+    node.download_capacity = 0 if stopping else sum(thread.is_alive() for thread in download_threads)
+    node.current_jobs = sum(stage == 'process' for worker_id, video_id, stage in jobs.values())
+    node.current_downloads = sum(stage == 'download' for worker_id, video_id, stage in jobs.values())
+    node.last_heartbeat_at = datetime.utcnow()
+    db.session.commit()
+
+def remove_worker_node():
+    """Drop this process from the worker registry once it has stopped"""
+    WorkerNode.query.filter_by(id=get_node_id()).delete(synchronize_session=False)
+    db.session.commit()
+
+def prune_worker_nodes():
+    """Forget worker nodes that died without unregistering"""
+    from app import app
+    
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['PROCESSING_LEASE_SECONDS'] * WORKER_NODE_RETENTION_LEASES)
+    WorkerNode.query.filter(WorkerNode.last_heartbeat_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+def renew_leases(jobs):
+    """Extend the leases of the given running jobs (queue item id -> (worker id, video id))
+    
+    Jobs whose row was deleted (the video was deleted, possibly through
+    another process) or taken over by another worker are cancelled here.
+    """
+    from app import app
+    
+    if not jobs:
+        return
+    
+    now = datetime.utcnow()
+    ProcessingQueue.query.filter(
+        ProcessingQueue.id.in_(list(jobs)),
+        ProcessingQueue.worker_id.in_({worker_id for worker_id, video_id, stage in jobs.values()}),
+        ProcessingQueue.status == 'processing'
+    ).update({
+        'heartbeat_at': now,
+        'lease_expires_at': now + timedelta(seconds=app.config['PROCESSING_LEASE_SECONDS'])
+    }, synchronize_session=False)
+    db.session.commit()
+    
+    owners = dict(db.session.query(ProcessingQueue.id, ProcessingQueue.worker_id).filter(
+        ProcessingQueue.id.in_(list(jobs))
+    ))
+    for queue_item_id, (worker_id, video_id, stage) in jobs.items():
+        if owners.get(queue_item_id) != worker_id:
+            logger.info(f"Job {queue_item_id} (video {video_id}) was deleted or reassigned, cancelling it")
+            cancel_job(video_id)
+
+def reap_expired_jobs():
+    """Requeue processing jobs whose worker stopped renewing the lease (crashed, killed or redeployed)
+
+    Partial outputs are removed before the job becomes claimable again. Jobs
+    that have used up PROCESSING_MAX_ATTEMPTS are marked failed instead.
+    Returns the number of jobs requeued.
+    """
+    from app import app
+    
+    now = datetime.utcnow()
+    expired = ProcessingQueue.query.filter(
+        ProcessingQueue.status == 'processing',
+        ProcessingQueue.lease_expires_at < now
+    ).all()
+    
+    requeued = 0
+    for queue_item in expired:
+        attempts = queue_item.attempts or 0
+        retry = attempts < app.config['PROCESSING_MAX_ATTEMPTS']
         
-        # Process the video outside the lock
+        # Conditional update, so only one process reaps each job
+        reaped = ProcessingQueue.query.filter(
+            ProcessingQueue.id == queue_item.id,
+            ProcessingQueue.status == 'processing',
+            ProcessingQueue.lease_expires_at < now
+        ).update({
+            'status': 'queued' if retry else 'failed',
+            'next_attempt_at': now + timedelta(seconds=retry_delay(attempts)) if retry else None,  # Don't crash-loop
+            'worker_id': None,
+            'lease_expires_at': None,
+            'heartbeat_at': None,
+            'progress': None,
+            'encode_speed': None,
+            'eta_seconds': None
+        }, synchronize_session=False)
+        if not reaped:
+            db.session.rollback()
+            continue
+        
+        # Clean up while the row is still locked by this transaction
+        video = Video.query.get(queue_item.video_id)
+        if video:
+            remove_partial_outputs(video.slug, app.config['UPLOAD_FOLDER'], keep_original=True)
+            video.status = 'pending' if retry else 'failed'
+            if not retry:
+                video.error = f"Processing was interrupted {attempts} times"
+        
+        if retry:
+            logger.warning(f"Requeued job {queue_item.id} for video {queue_item.video_id} after its lease expired "
+                           f"(attempt {attempts} by {queue_item.worker_id})")
+            requeued += 1
+        else:
+            logger.error(f"Job {queue_item.id} for video {queue_item.video_id} failed after {attempts} interrupted attempts")
+        
+        db.session.commit()
+    
+    if requeued:
+        notify_queue()
+    return requeued
+
+def get_node_id():
+    """Identify this process across hosts and restarts (host:pid:token), its row in the worker registry"""
+    return f"{socket.gethostname()}:{os.getpid()}:{PROCESS_TOKEN}"
+
+def get_worker_id():
+    """Identify this worker across processes and hosts (host:pid:token:thread)"""
+    return f"{get_node_id()}:{threading.current_thread().name}"
+
+def claim_next_job(stage='process'):
+    """Atomically claim the highest-priority queued item of a stage ('download' or 'process'), safe across processes
+
+    Postgres uses SELECT ... FOR UPDATE SKIP LOCKED so concurrent workers skip rows
+    another transaction is claiming. Other databases (SQLite) use a conditional
+    UPDATE that only succeeds while the row is still queued.
+    """
+    from app import app
+    
+    now = datetime.utcnow()
+    claim = {
+        'status': 'processing',
+        'started_at': now,
+        'worker_id': get_worker_id(),
+        'heartbeat_at': now,
+        'lease_expires_at': now + timedelta(seconds=app.config['PROCESSING_LEASE_SECONDS']),
+        'attempts': ProcessingQueue.attempts + 1
+    }
+    next_queued = ProcessingQueue.query.filter(
+        ProcessingQueue.status == 'queued',
+        ProcessingQueue.stage == stage,
+        or_(ProcessingQueue.next_attempt_at.is_(None), ProcessingQueue.next_attempt_at <= now)
+    ).order_by(
+        ProcessingQueue.priority.desc(),
+        ProcessingQueue.created_at.asc()
+    )
+    
+    if db.engine.dialect.name == 'postgresql':
+        queue_item = next_queued.with_for_update(skip_locked=True).first()
+        if not queue_item:
+            db.session.rollback()
+            return None
+        
+        for field, value in claim.items():
+            setattr(queue_item, field, value)
+        db.session.commit()
+        return queue_item
+    
+    # Another worker may win the race for the candidate row, so try a few times
+    for _ in range(5):
+        candidate = next_queued.first()
+        if not candidate:
+            return None
+        
+        claimed = ProcessingQueue.query.filter_by(id=candidate.id, status='queued').update(
+            claim, synchronize_session=False
+        )
+        db.session.commit()
+        
+        if claimed:
+            return ProcessingQueue.query.get(candidate.id)
+    
+    return None
+
+def process_next():
+    """Process the next video in the queue"""
+    from app import app
+    
+    with app.app_context():
+        # Claim the next queued video with highest priority
+        queue_item = claim_next_job('process')
+        if not queue_item:
+            return False
+        
+        logger.debug(f"Worker {queue_item.worker_id} claimed queue item {queue_item.id}")
+        
+        video = Video.query.get(queue_item.video_id)
+        if video:
+            video.status = 'processing'
+        
+        db.session.commit()
+        
+        # Kept aside for cleanup, the rows may be deleted while the video processes
+        queue_item_id, video_id, slug = queue_item.id, queue_item.video_id, video.slug if video else None
+        worker_id = queue_item.worker_id
+        
+        # The heartbeat renews the lease for as long as the job runs here
+        with running_jobs_lock:
+            running_jobs[queue_item_id] = (worker_id, video_id, 'process')
+        
+        # Process the video
         try:
             if video:
-                logger.info(f"Processing video {video.id} ({video.slug})")
-                
-                # Process the video
-                success = process_video(video, app.config['UPLOAD_FOLDER'])
-                
-                # Update the status
-                if success:
-                    queue_item.status = 'completed'
-                    queue_item.completed_at = datetime.utcnow()
-                    video.status = 'completed'
-                else:
-                    queue_item.status = 'failed'
-                    video.status = 'failed'
-                    video.error = "Failed to process video"
-                
-                db.session.commit()
-                return True
+                with job_scope(video.id):
+                    # Resumable uploads are hashed here rather than in the finalize request
+                    if not video.content_hash and video.original_path:
+                        video.content_hash = hash_file(video.original_path)
+                        db.session.commit()
+                    
+                    # An identical upload may have finished processing while this one was queued
+                    source = find_completed_duplicate(video)
+                    if source is not None:
+                        link_to_existing_outputs(video, source)
+                        queue_item.status = 'completed'
+                        queue_item.completed_at = datetime.utcnow()
+                        queue_item.processing_mode = 'dedup'
+                        queue_item.lease_expires_at = None
+                        db.session.commit()
+                        return True
+                    
+                    logger.info(f"Processing video {video.id} ({video.slug})")
+                    
+                    # Process the video
+                    success = process_video(video, app.config['UPLOAD_FOLDER'], queue_item)
+                    
+                    # Update the status
+                    if success:
+                        queue_item.status = 'completed'
+                        queue_item.completed_at = datetime.utcnow()
+                        queue_item.progress = 100.0
+                        queue_item.eta_seconds = 0.0
+                        video.status = 'completed'
+                        video.error = None
+                    else:
+                        queue_item.status = 'failed'
+                        video.status = 'failed'
+                        video.error = "Failed to process video"
+                    
+                    queue_item.lease_expires_at = None
+                    db.session.commit()
+                    return True
+            
+        except JobCancelled:
+            # The video was deleted, or the job was reaped and handed to another worker
+            logger.info(f"Processing of video {video_id} was cancelled")
+            db.session.rollback()
             
+            current = ProcessingQueue.query.get(queue_item_id)
+            if current is not None and current.worker_id == worker_id and stop_event.is_set():
+                hand_back_job(queue_item_id, worker_id, video_id, slug)
+            elif current is None or current.worker_id == worker_id:
+                ProcessingQueue.query.filter_by(id=queue_item_id).update({
+                    'status': 'failed',
+                    'lease_expires_at': None
+                }, synchronize_session=False)
+                db.session.commit()
+                remove_partial_outputs(slug, app.config['UPLOAD_FOLDER'])
+            return True
+        
         except Exception as e:
             logger.exception(f"Error processing video: {e}")
+            db.session.rollback()
+            
+            # Rate limits, outages and timeouts are retried later with backoff
+            if retry_later(queue_item, video, slug, e):
+                return True
             
             # Update the status
             queue_item.status = 'failed'
+            queue_item.lease_expires_at = None
             if video:
                 video.status = 'failed'
                 video.error = str(e)
             
             db.session.commit()
             return True
+        
+        finally:
+            with running_jobs_lock:
+                running_jobs.pop(queue_item_id, None)
     
     return False
 
-def process_video(video, upload_folder):
-    """Process a video - generate thumbnail and transcode"""
+def download_next():
+    """Download the next queued link; a successful download queues the video for processing"""
+    from app import app
+    from downloader import download_video
+    
+    with app.app_context():
+        queue_item = claim_next_job('download')
+        if not queue_item:
+            return False
+        
+        # Kept aside for cleanup, the rows may be deleted while the video downloads
+        queue_item_id, video_id, worker_id = queue_item.id, queue_item.video_id, queue_item.worker_id
+        video = Video.query.get(video_id)
+        if video is None:
+            queue_item.status = 'failed'
+            queue_item.lease_expires_at = None
+            db.session.commit()
+            return True
+        
+        url, slug = video.source_url, video.slug
+        video.status = 'downloading'
+        db.session.commit()
+        
+        # The heartbeat renews the lease for as long as the download runs here
+        with running_jobs_lock:
+            running_jobs[queue_item_id] = (worker_id, video_id, 'download')
+        
+        try:
+            # The scope outlives download_video, so a cancellation is still visible after it returns
+            with job_scope(video_id):
+                logger.info(f"Downloading video {video_id} from {url}")
+                success = download_video(video_id, url)
+                cancelled = is_cancelled(video_id)
+            
+            if db.session.query(Video.id).filter_by(id=video_id).first() is None:
+                # Deleted while downloading, possibly through another process: remove what was written
+                remove_partial_outputs(slug, app.config['UPLOAD_FOLDER'])
+                return True
+            
+            if cancelled:
+                # Deleted (delete_video cleans up), reaped by another worker, or interrupted by a shutdown
+                if stop_event.is_set():
+                    hand_back_job(queue_item_id, worker_id, video_id, slug)
+                return True
+            
+            # download_video has either marked the video failed or queued it for processing
+            ProcessingQueue.query.filter_by(id=queue_item_id, worker_id=worker_id).update({
+                'status': 'completed' if success else 'failed',
+                'completed_at': datetime.utcnow(),
+                'lease_expires_at': None
+            }, synchronize_session=False)
+            db.session.commit()
+            return True
+        
+        except Exception as e:
+            logger.warning(f"Error downloading video {video_id}: {e}")
+            db.session.rollback()
+            
+            if retry_later(queue_item, video, slug, e):
+                return True
+            
+            queue_item.status = 'failed'
+            queue_item.lease_expires_at = None
+            video.status = 'failed'
+            video.error = f"Download failed after {queue_item.attempts} attempts: {e}"
+            db.session.commit()
+            return True
+        
+        finally:
+            with running_jobs_lock:
+                running_jobs.pop(queue_item_id, None)
+
+def retry_later(queue_item, video, slug, error):
+    """Requeue a job that failed transiently, with backoff
+    
+    Returns False when the error is permanent or the job has used up
+    PROCESSING_MAX_ATTEMPTS; the caller then marks it failed.
+    """
+    from app import app
+    
+    attempts = queue_item.attempts or 0
+    if not is_transient_error(error) or attempts >= app.config['PROCESSING_MAX_ATTEMPTS']:
+        return False
+    
+    delay = retry_delay(attempts)
+    queue_item.status = 'queued'
+    queue_item.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+    queue_item.worker_id = None
+    queue_item.lease_expires_at = None
+    queue_item.progress = None
+    if video:
+        video.status = 'pending'
+        video.error = f"Temporary error, retrying in {delay:.0f}s: {error}"
+    remove_partial_outputs(slug, app.config['UPLOAD_FOLDER'], keep_original=True)
+    db.session.commit()
+    logger.warning(f"Job {queue_item.id} for video {queue_item.video_id} failed transiently "
+                   f"(attempt {attempts}), retrying in {delay:.0f}s")
+    return True
+
+def hand_back_job(queue_item_id, worker_id, video_id, slug):
+    """Return a job interrupted by a shutdown to the queue for another worker"""
+    from app import app
+    
+    remove_partial_outputs(slug, app.config['UPLOAD_FOLDER'], keep_original=True)
+    ProcessingQueue.query.filter_by(id=queue_item_id, worker_id=worker_id).update({
+        'status': 'queued',
+        'worker_id': None,
+        'lease_expires_at': None,
+        'heartbeat_at': None,
+        'progress': None
+    }, synchronize_session=False)
+    Video.query.filter_by(id=video_id).update({'status': 'pending'}, synchronize_session=False)
+    notify_queue()
+
+def process_video(video, upload_folder, queue_item=None):
+    """Process a video - generate thumbnail and transcode
+    
+    Everything is encoded into a private scratch directory and only published
+    into the upload folder once finished, so readers never see partial output.
+    """
+    scratch_dir = None
     try:
         # Make sure we have an original file to process
         if not video.original_path or not os.path.exists(video.original_path):
             raise Exception("Original video file not found")
         
-        # Create output paths
-        processed_dir = os.path.join(upload_folder, 'processed')
-        thumbnail_dir = os.path.join(upload_folder, 'thumbnails')
-        hls_dir = os.path.join(upload_folder, 'hls', video.slug)
-        
-        os.makedirs(processed_dir, exist_ok=True)
-        os.makedirs(thumbnail_dir, exist_ok=True)
+        # Create output paths in the job's scratch directory
+        scratch_dir = create_scratch_dir(video.slug)
+        hls_dir = os.path.join(scratch_dir, 'hls')
+        mp4_output = os.path.join(scratch_dir, f"{video.slug}.mp4")
+        thumbnail_output = os.path.join(scratch_dir, f"{video.slug}.jpg")
         os.makedirs(hls_dir, exist_ok=True)
         
-        mp4_output = os.path.join(processed_dir, f"{video.slug}.mp4")
-        thumbnail_output = os.path.join(thumbnail_dir, f"{video.slug}.jpg")
-        hls_playlist = os.path.join(hls_dir, "playlist.m3u8")
-        
-        # Get video information
-        video_info = get_video_info(video.original_path)
+        # Get video information (probed once and stored on the video)
+        video_info = get_video_info(video.original_path, video)
         
         # Update the video with metadata
         video.duration = float(video_info.get('duration', 0))
@@ -146,61 +892,472 @@ def process_video(video, upload_folder):
         
         db.session.commit()
         
-        # Generate thumbnail
-        extract_thumbnail(video.original_path, thumbnail_output)
-        video.thumbnail_path = os.path.join('thumbnails', f"{video.slug}.jpg")
+        # Report encode progress on the queue item while ffmpeg runs
+        on_progress = make_progress_callback(queue_item) if queue_item is not None else None
         
-        # Transcode to MP4
-        transcode_to_mp4(video.original_path, mp4_output)
-        video.processed_path = os.path.join('processed', f"{video.slug}.mp4")
+        original_path, duration, slug = video.original_path, video.duration, video.slug
+        published_hls_dir = os.path.join(upload_folder, 'hls', slug)
+        published_mp4 = os.path.join(upload_folder, 'processed', f"{slug}.mp4")
         
-        # Create HLS stream
-        create_hls_stream(mp4_output, hls_dir)
-        video.hls_path = os.path.join('hls', video.slug, 'playlist.m3u8')
+        def make_thumbnail():
+            extract_thumbnail(original_path, thumbnail_output, duration)
+            if not os.path.exists(thumbnail_output):
+                return False
+            publish_output(thumbnail_output, os.path.join(upload_folder, 'thumbnails', f"{slug}.jpg"))
+            return True
+        
+        def encode():
+            return encode_outputs(original_path, mp4_output, hls_dir, video_info, duration, on_progress,
+                                  mp4_ref=os.path.relpath(published_mp4, published_hls_dir))
+        
+        def publish(encoded):
+            publish_output(hls_dir, published_hls_dir)
+            publish_output(mp4_output, published_mp4)
+            return encoded
+        
+        # Results are committed as each stage finishes, so the thumbnail shows up long before the encode is done
+        def on_stage_done(stage, result):
+            if stage == 'thumbnail':
+                video.thumbnail_path = os.path.join('thumbnails', f"{slug}.jpg") if result else None
+            elif stage == 'publish':
+                processing_mode, hls_playlist = result
+                if queue_item is not None:
+                    queue_item.processing_mode = processing_mode
+                video.processed_path = os.path.join('processed', f"{slug}.mp4")
+                video.hls_path = os.path.join('hls', slug, hls_playlist)
+            db.session.commit()
+        
+        # Stages only wait for the stages they need, independent ones run side by side
+        run_stage_graph({
+            'thumbnail': ((), make_thumbnail),
+            'encode': ((), encode),
+            'publish': (('encode',), publish),
+        }, on_stage_done)
         
         db.session.commit()
         return True
         
     except Exception as e:
+        # Transient failures go back to process_next to be retried
+        if is_transient_error(e):
+            raise
+        
         logger.exception(f"Error processing video {video.id}: {e}")
         video.error = str(e)
         db.session.commit()
         return False
+    
+    finally:
+        if scratch_dir is not None:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
 
-def get_video_info(video_path):
-    """Get video metadata using FFprobe"""
-    cmd = [
-        'ffprobe',
-        '-v', 'quiet',
-        '-print_format', 'json',
-        '-show_format',
-        '-show_streams',
-        video_path
-    ]
+def encode_outputs(input_path, mp4_output, hls_dir, video_info, duration, on_progress=None, mp4_ref=None):
+    """Encode the MP4 and the HLS ladder, picking the cheapest method that works
+    
+    `mp4_ref` is the published MP4's path relative to the published HLS
+    directory, for the single-file fallback playlist.
+    Returns (processing_mode, HLS playlist name).
+    """
+    # Sources that are already web-compatible only need a stream-copy remux (lower renditions are still encoded)
+    hls_playlist = 'master.m3u8'
+    processing_mode = 'remux' if can_remux(video_info) else 'transcode'
+    if processing_mode == 'remux':
+        logger.info(f"{input_path} is already H.264/AAC MP4, remuxing without re-encoding")
+        renditions = get_hls_renditions(video_info, remux=True)
+        if not transcode_to_mp4_and_hls(input_path, mp4_output, hls_dir, renditions, remux=True,
+                                        duration=duration, on_progress=on_progress):
+            logger.warning(f"Remux failed for {input_path}, transcoding instead")
+            processing_mode = 'transcode'
+        elif len(renditions) > 1:
+            # The lower rungs were decoded and encoded, so this is not the seconds-long pure stream copy
+            processing_mode = 'remux+ladder'
+    
+    # Long sources are split at keyframes and their chunks encoded in parallel
+    if processing_mode == 'transcode' and use_chunked_encoding(duration):
+        if transcode_chunked(input_path, mp4_output, hls_dir, get_hls_renditions(video_info),
+                             video_info, duration, on_progress=on_progress):
+            processing_mode = 'chunked'
+        else:
+            logger.warning(f"Chunked encoding failed for {input_path}, encoding the whole file instead")
+    
+    # Transcode the MP4 and every HLS rendition from a single decode
+    if processing_mode == 'transcode' and not transcode_to_mp4_and_hls(
+            input_path, mp4_output, hls_dir, get_hls_renditions(video_info),
+            duration=duration, on_progress=on_progress):
+        # Fall back to the separate MP4 and single-rendition HLS passes
+        transcode_to_mp4(input_path, mp4_output, duration=duration, on_progress=on_progress)
+        create_hls_stream(mp4_output, hls_dir, duration=duration, on_progress=on_progress, mp4_ref=mp4_ref)
+        hls_playlist = 'playlist.m3u8'
     
+    return processing_mode, hls_playlist
+
+def run_stage_graph(stages, on_stage_done=None):
+    """Run a job's stages as a small DAG, each starting as soon as the stages it depends on have finished
+    
+    `stages` maps a name to (dependency names, function); the function is called
+    with its dependencies' results, on a pool thread under the current job. The
+    calling thread gets on_stage_done(name, result) for every finished stage, so
+    it can commit results while other stages still run. After a failure no new
+    stage starts and the first error is raised once the running ones are done.
+    """
+    from app import app
+    
+    video_id = current_video_id()
+    results = {}
+    waiting = dict(stages)
+    running = {}
+    failure = None
+    
+    def run_stage(name):
+        dependencies, function = stages[name]
+        with app.app_context(), job_scope(video_id):
+            return function(*(results[dependency] for dependency in dependencies))
+    
+    with ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix='stage') as pool:
+        while True:
+            if failure is None:
+                for name, (dependencies, _) in list(waiting.items()):
+                    if all(dependency in results for dependency in dependencies):
+                        running[pool.submit(run_stage, name)] = name
+                        del waiting[name]
+            if not running:
+                break
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except BaseException as e:  # Including JobCancelled
+                    failure = failure or e
+                    continue
+                if on_stage_done is not None and failure is None:
+                    on_stage_done(name, results[name])
+    
+    if failure is not None:
+        raise failure
+    if waiting:
+        raise ValueError(f"Stages with unmet dependencies: {', '.join(waiting)}")
+    return results
+
+def create_scratch_dir(slug):
+    """Create a private scratch directory for one job, tagged with the worker node that owns it"""
+    from app import app
+    
+    os.makedirs(app.config['SCRATCH_FOLDER'], exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix=f"{slug}-", dir=app.config['SCRATCH_FOLDER'])
+    with open(os.path.join(scratch_dir, SCRATCH_OWNER_FILE), 'w') as f:
+        f.write(get_node_id())
+    return scratch_dir
+
+def publish_output(staged_path, final_path):
+    """Move a finished file or directory from scratch into place with an atomic rename
+    
+    When scratch is on another filesystem (local SSD or tmpfs in front of a NAS)
+    the output is first copied in bulk next to its destination, so the rename
+    that makes it visible stays atomic. An existing output is replaced.
+    """
+    # Don't publish for a video that was deleted while it encoded
+    raise_if_cancelled()
+    
+    parent = os.path.dirname(final_path)
+    os.makedirs(parent, exist_ok=True)
+    name = os.path.basename(final_path)
+    
+    incoming_dir = None
+    replaced_dir = None
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        if os.stat(staged_path).st_dev != os.stat(parent).st_dev:
+            incoming_dir = tempfile.mkdtemp(prefix=f".incoming-{name}-", dir=parent)
+            incoming_path = os.path.join(incoming_dir, name)
+            if os.path.isdir(staged_path):
+                shutil.copytree(staged_path, incoming_path)
+            else:
+                shutil.copyfile(staged_path, incoming_path)
+            staged_path = incoming_path
+        
+        # A directory can only be renamed over an empty one, so move a previous output aside first
+        if os.path.isdir(staged_path) and os.path.isdir(final_path):
+            replaced_dir = tempfile.mkdtemp(prefix=f".replaced-{name}-", dir=parent)
+            os.rename(final_path, os.path.join(replaced_dir, name))
+        
+        os.replace(staged_path, final_path)
+        logger.debug(f"Published {final_path}")
+    
+    finally:
+        for leftover in (incoming_dir, replaced_dir):
+            if leftover is not None:
+                shutil.rmtree(leftover, ignore_errors=True)
+
+def clean_abandoned_scratch():
+    """Remove scratch directories whose worker node is gone (killed mid-job or restarted)
+    
+    Directories younger than a lease are left alone, their owner may not have
+    registered yet. Returns the number of directories removed.
+    """
+    from app import app
+    
+    scratch_root = app.config['SCRATCH_FOLDER']
+    if not os.path.isdir(scratch_root):
+        return 0
+    
+    lease_seconds = app.config['PROCESSING_LEASE_SECONDS']
+    online_nodes = {node.id for node in WorkerNode.query.all() if node.is_online(lease_seconds)}
+    
+    removed = 0
+    for entry in os.scandir(scratch_root):
+        if not entry.is_dir() or time.time() - entry.stat().st_mtime < lease_seconds:
+            continue
+        
+        try:
+            with open(os.path.join(entry.path, SCRATCH_OWNER_FILE)) as f:
+                owner = f.read().strip()
+        except OSError:
+            owner = None
+        
+        if owner not in online_nodes:
+            logger.info(f"Removing abandoned scratch directory {entry.path} (owner {owner or 'unknown'})")
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    return removed
+
+def expire_upload_sessions():
+    """Delete resumable uploads that saw no chunk for UPLOAD_SESSION_TTL seconds, with their files
+    
+    Sessions left 'finalizing' never got a video either, so the file their
+    finalize moved to its permanent name is removed too. Returns the number
+    of sessions removed.
+    """
+    from app import app
+    
+    ttl = app.config['UPLOAD_SESSION_TTL']
+    if ttl <= 0:
+        return 0
+    
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    recent_chunks = db.session.query(UploadChunk.upload_id).filter(UploadChunk.created_at >= cutoff)
+    stale = UploadSession.query.filter(
+        UploadSession.status.in_(('uploading', 'finalizing')),
+        UploadSession.updated_at < cutoff,
+        ~UploadSession.id.in_(recent_chunks)
+    ).all()
+    
+    removed = 0
+    for upload in stale:
+        upload_id, filename, paths = upload.id, upload.filename, (upload.file_path, upload.final_path())
+        
+        # Conditional delete, so only one process removes each session and a resumed one is kept
+        deleted = UploadSession.query.filter(
+            UploadSession.id == upload_id,
+            UploadSession.status == upload.status,
+            UploadSession.updated_at < cutoff,
+            ~UploadSession.id.in_(recent_chunks)
+        ).delete(synchronize_session=False)
+        if deleted:
+            UploadChunk.query.filter_by(upload_id=upload_id).delete(synchronize_session=False)
+        db.session.commit()
+        if not deleted:
+            continue
+        
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        logger.info(f"Expired abandoned upload {upload_id} ({filename})")
+        removed += 1
+    return removed
+
+def make_progress_callback(queue_item):
+    """Build an ffmpeg progress callback that stores progress on a queue item (throttled)"""
+    last_update = [0.0]
+    
+    # Read up front, the callback runs on the encode stage's thread outside this session
+    queue_item_id, video_id, worker_id = queue_item.id, queue_item.video_id, queue_item.worker_id
+    
+    def on_progress(percent, speed, eta_seconds, force=False):
+        now = time.monotonic()
+        if not force and now - last_update[0] < PROGRESS_UPDATE_INTERVAL:
+            return
+        last_update[0] = now
+        
+        updated = ProcessingQueue.query.filter_by(id=queue_item_id, worker_id=worker_id).update({
+            'progress': percent,
+            'encode_speed': speed,
+            'eta_seconds': eta_seconds,
+            'progress_updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        
+        # The queue item disappears when its video is deleted, possibly by another process,
+        # and changes hands when the reaper gave the job to another worker
+        if not updated:
+            logger.info(f"Queue item {queue_item_id} is no longer ours, cancelling the job for video {video_id}")
+            cancel_job(video_id)
+    
+    return on_progress
+
+def parse_ffmpeg_time(value):
+    """Convert an ffmpeg HH:MM:SS.micro timestamp to seconds"""
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def run_ffmpeg(cmd, duration=None, on_progress=None, stage='transcode'):
+    """Run an ffmpeg command, reading its -progress stream as it encodes
+
+    When `on_progress` is given it is called with (percent, speed, eta_seconds)
+    computed from out_time against `duration`. Returns a CompletedProcess with
+    the ffmpeg stderr, like subprocess.run(capture_output=True) would. The
+    process is killed if it outlives the stage budget or the job is cancelled.
+    """
+    cmd = [cmd[0], '-progress', 'pipe:1', '-nostats'] + cmd[1:]
+    with managed_process(cmd, stage, duration, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
+        return read_ffmpeg_progress(cmd, process, duration, on_progress)
+
+def read_ffmpeg_progress(cmd, process, duration, on_progress):
+    """Parse the -progress blocks of a running ffmpeg until it exits"""
+    # Drain stderr on a separate thread so a chatty ffmpeg never blocks on a full pipe
+    stderr_lines = []
+    stderr_thread = threading.Thread(target=lambda: stderr_lines.extend(process.stderr))
+    stderr_thread.daemon = True
+    stderr_thread.start()
+    
+    block = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        if key != 'progress':
+            block[key] = value
+            continue
+        
+        # A "progress=continue|end" line closes each block of key=value pairs
+        if on_progress and duration:
+            try:
+                out_time = parse_ffmpeg_time(block.get('out_time', '00:00:00'))
+            except ValueError:
+                out_time = 0
+            
+            speed = block.get('speed', '').rstrip('x').strip()
+            speed = float(speed) if speed and speed != 'N/A' else None
+            
+            percent = max(0.0, min(100.0, out_time / duration * 100))
+            eta_seconds = (duration - out_time) / speed if speed else None
+            
+            if value == 'end':
+                percent, eta_seconds = 100.0, 0.0
+            
+            try:
+                # The final block bypasses the write throttle, so 100% is always recorded
+                on_progress(round(percent, 1), speed, eta_seconds, force=value == 'end')
+            except Exception as e:
+                logger.warning(f"Failed to record ffmpeg progress: {e}")
+        
+        block = {}
+    
+    returncode = process.wait()
+    stderr_thread.join()
+    
+    return subprocess.CompletedProcess(cmd, returncode, stdout='', stderr=''.join(stderr_lines))
+
+def probe_cache_key(video_path):
+    """Build a probe cache key that changes whenever the file is replaced or modified"""
+    stat = os.stat(video_path)
+    return f"{os.path.abspath(video_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def probe_video(video_path, video=None):
+    """Run FFprobe on a file, reusing a cached result for the same path, size and mtime
+
+    Results are kept in memory for this process and, when a Video is given, persisted
+    on the row so later stages and reprocessing skip the ffprobe subprocess entirely.
+    """
+    key = probe_cache_key(video_path)
+    
+    with probe_cache_lock:
+        if key in probe_cache:
+            probe_cache.move_to_end(key)
+            return probe_cache[key]
+    
+    data = None
+    if video is not None and video.probe_key == key and video.probe_data:
+        try:
+            data = json.loads(video.probe_data)
+            logger.debug(f"Using stored probe data for {video_path}")
+        except ValueError:
+            data = None
+    
+    if data is None:
+        cmd = [
+            'ffprobe',
+            '-v', 'quiet',
+            '-print_format', 'json',
+            '-show_format',
+            '-show_streams',
+            video_path
+        ]
+        
+        result = run_process(cmd, 'probe')
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
         data = json.loads(result.stdout)
+    
+    if video is not None:
+        video.probe_key = key
+        video.probe_data = json.dumps(data)
+    
+    with probe_cache_lock:
+        probe_cache[key] = data
+        while len(probe_cache) > PROBE_CACHE_SIZE:
+            probe_cache.popitem(last=False)
+    
+    return data
+
+def get_video_info(video_path, video=None):
+    """Get video metadata using FFprobe"""
+    try:
+        data = probe_video(video_path, video)
         
         # Extract relevant information
         info = {
             'filename': os.path.basename(video_path)
         }
         
-        # Get duration from format
-        if 'format' in data and 'duration' in data['format']:
-            info['duration'] = float(data['format']['duration'])
+        # Get duration, container and overall bitrate from format
+        if 'format' in data:
+            if 'duration' in data['format']:
+                info['duration'] = float(data['format']['duration'])
+            if 'format_name' in data['format']:
+                info['format_name'] = data['format']['format_name']
+            if 'bit_rate' in data['format']:
+                info['bit_rate'] = int(data['format']['bit_rate'])
         
-        # Get video stream information
+        # Get the first video and audio stream
         video_stream = None
+        audio_stream = None
         for stream in data.get('streams', []):
-            if stream.get('codec_type') == 'video':
+            if stream.get('codec_type') == 'video' and video_stream is None:
                 video_stream = stream
-                break
+            elif stream.get('codec_type') == 'audio' and audio_stream is None:
+                audio_stream = stream
+        
+        if audio_stream:
+            info['audio_codec'] = audio_stream.get('codec_name')
+            info['audio_profile'] = audio_stream.get('profile')
         
         if video_stream:
             info['width'] = int(video_stream.get('width', 0))
             info['height'] = int(video_stream.get('height', 0))
+            info['video_codec'] = video_stream.get('codec_name')
+            info['video_profile'] = video_stream.get('profile')
+            info['video_level'] = video_stream.get('level')
+            info['pix_fmt'] = video_stream.get('pix_fmt')
+            
+            # Frame rate, used to pick the H.264 level of the HLS renditions
+            for rate_key in ('avg_frame_rate', 'r_frame_rate'):
+                fps_parts = video_stream.get(rate_key, '0/0').split('/')
+                if len(fps_parts) == 2 and float(fps_parts[0]) > 0 and float(fps_parts[1]) > 0:
+                    info['frame_rate'] = float(fps_parts[0]) / float(fps_parts[1])
+                    break
+            
+            # Prefer the video stream bitrate over the overall container bitrate
+            if 'bit_rate' in video_stream:
+                info['bit_rate'] = int(video_stream['bit_rate'])
             
             # Calculate duration from framerate and frames if not available
             if 'duration' not in info and 'r_frame_rate' in video_stream and 'nb_frames' in video_stream:
@@ -212,16 +1369,47 @@ def get_video_info(video_path):
         
         return info
         
+    except subprocess.TimeoutExpired:
+        # A probe over its budget means a bad source, don't carry on with an empty probe
+        raise
     except Exception as e:
         logger.error(f"Error getting video info: {e}")
         return {}
 
-def extract_thumbnail(video_path, output_path):
+def can_remux(info):
+    """Check whether a probed source can be stream-copied instead of re-encoded"""
+    from app import app
+    
+    # MP4/MOV container (ffprobe reports "mov,mp4,m4a,3gp,3g2,mj2")
+    if 'mp4' not in info.get('format_name', '').split(','):
+        return False
+    
+    # H.264 video in a profile and pixel format every browser can decode
+    if info.get('video_codec') != 'h264':
+        return False
+    if info.get('video_profile') not in ('Constrained Baseline', 'Baseline', 'Main', 'High'):
+        return False
+    if info.get('pix_fmt') not in ('yuv420p', 'yuvj420p'):
+        return False
+    
+    # AAC audio, or no audio at all
+    if info.get('audio_codec') not in (None, 'aac'):
+        return False
+    
+    # Very high bitrate sources still get re-encoded so they stream smoothly
+    max_bitrate = app.config['REMUX_MAX_BITRATE']
+    if max_bitrate > 0 and info.get('bit_rate', 0) > max_bitrate:
+        return False
+    
+    return True
+
+def extract_thumbnail(video_path, output_path, duration=None):
     """Extract a thumbnail from the video at the 5 second mark or 25% point"""
     try:
-        # Get video duration
-        info = get_video_info(video_path)
-        duration = float(info.get('duration', 0))
+        # Get video duration, unless the caller already probed it
+        if duration is None:
+            info = get_video_info(video_path)
+            duration = float(info.get('duration', 0))
         
         # Extract at 5 seconds or 25% of duration if less than 20 seconds
         seek_time = min(5, max(1, duration * 0.25)) if duration > 0 else 0
@@ -243,7 +1431,7 @@ def extract_thumbnail(video_path, output_path):
             ]
             
             logger.debug(f"Running command: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            result = run_process(cmd, 'thumbnail')
             
             if result.returncode != 0:
                 logger.warning(f"ffmpeg thumbnail extraction returned error: {result.stderr}")
@@ -274,7 +1462,7 @@ def extract_thumbnail(video_path, output_path):
                     output_path
                 ]
                 
-                result = subprocess.run(cmd, capture_output=True, text=True)
+                result = run_process(cmd, 'thumbnail')
                 
                 if result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
                     # If even the placeholder creation failed, use a more direct method
@@ -309,7 +1497,484 @@ def extract_thumbnail(video_path, output_path):
         logger.error(f"Error in extract_thumbnail: {e}")
         return False
 
-def transcode_to_mp4(input_path, output_path):
+def get_hls_renditions(info, remux=False):
+    """Build the HLS bitrate ladder for a source from the configured heights, capped at the source resolution
+    
+    Ladder heights apply to the short side, so a portrait 1080x1920 source is
+    "1080p". The top rendition, which is also the downloadable MP4, is always
+    the source resolution, even when it is above the configured ladder.
+    """
+    from app import app
+    
+    source_width = info.get('width', 0)
+    source_height = info.get('height', 0)
+    frame_rate = info.get('frame_rate') or 30
+    ladder = sorted(set(app.config['HLS_RENDITIONS']), reverse=True)
+    
+    if not source_width or not source_height:
+        # Unknown geometry, encode a single rendition at the source size
+        return [make_rendition(source_width, source_height, frame_rate, scale=False)]
+    
+    short_side = min(source_width, source_height)
+    renditions = []
+    if remux:
+        # The source itself is the top rendition, only the lower ones are encoded
+        renditions.append(make_rendition(source_width, source_height, frame_rate, copy=True, info=info))
+        sizes = [size for size in ladder if size < short_side]
+    else:
+        sizes = sorted({size for size in ladder if size < short_side} | {short_side}, reverse=True)
+    
+    for size in sizes:
+        if size == short_side:
+            renditions.append(make_rendition(source_width, source_height, frame_rate, scale=False))
+            continue
+        
+        # Scale the short side to the ladder size; the width is the one ffmpeg picks for scale=-2:<height>
+        if source_width >= source_height:
+            height = size - size % 2
+        else:
+            height = int(size * source_height / (source_width * 2) + 0.5) * 2
+        width = int(height * source_width / (source_height * 2) + 0.5) * 2
+        renditions.append(make_rendition(width, height, frame_rate))
+    
+    return renditions
+
+def make_rendition(width, height, frame_rate, scale=True, copy=False, info=None):
+    """Describe one HLS rendition: size, bitrates and the H.264/AAC codec string for the master playlist"""
+    short_side = min(width, height)
+    if copy:
+        # Stream copy keeps the source profile and level
+        profile = H264_PROFILE_CODECS.get(info.get('video_profile'), '4D40')
+        video_codec = f"avc1.{profile}{int(info.get('video_level') or 40):02X}"
+        audio_codec = AAC_PROFILE_CODECS.get(info.get('audio_profile'), 'mp4a.40.2')
+        video_bitrate = int(info.get('bit_rate', 0) / 1000)
+        audio_bitrate = 128
+    else:
+        # Take the bitrates of the nearest ladder step at or above this size, scaled by pixel count
+        step = min((h for h in HLS_LADDER_BITRATES if h >= short_side), default=max(HLS_LADDER_BITRATES))
+        step_video_bitrate, audio_bitrate = HLS_LADDER_BITRATES[step]
+        video_bitrate = max(int(step_video_bitrate * (short_side * short_side) / (step * step)), 200)
+        level = h264_level(width, height, frame_rate, video_bitrate)
+        video_codec = f"avc1.4D40{level:02X}"  # Main profile as encoded by x264
+        audio_codec = 'mp4a.40.2'  # AAC-LC
+    
+    return {
+        'name': f"{short_side}p",
+        'width': width,
+        'height': height,
+        'copy': copy,
+        'scale': scale,
+        'video_bitrate': video_bitrate,  # kbit/s
+        'audio_bitrate': audio_bitrate,  # kbit/s
+        'level': None if copy else level,
+        'codecs': f"{video_codec},{audio_codec}",
+    }
+
+def h264_level(width, height, frame_rate, bitrate):
+    """Pick the lowest H.264 level whose frame size, macroblock rate and bitrate limits fit the rendition"""
+    macroblocks = ((width + 15) // 16) * ((height + 15) // 16)
+    for level, max_mbps, max_fs, max_br in H264_LEVELS:
+        if macroblocks <= max_fs and macroblocks * frame_rate <= max_mbps and bitrate <= max_br:
+            return level
+    return H264_LEVELS[-1][0]
+
+def tee_escape(path):
+    """Escape characters that have a special meaning in a tee muxer output list"""
+    for char in ('\\', '|', '[', ']', "'"):
+        path = path.replace(char, '\\' + char)
+    return path
+
+# Muxer options shared by every HLS rendition playlist
+HLS_OPTIONS = [
+    ('start_number', '0'),  # Start number for segments
+    ('hls_time', '4'),  # Segment duration in seconds
+    ('hls_list_size', '0'),  # All segments in playlist
+    ('hls_segment_type', 'mpegts'),  # More compatible segment type
+    ('hls_flags', 'independent_segments'),  # Each segment can be decoded independently
+]
+
+def available_cpus():
+    """CPU cores this process may run on (respects affinity/cpusets, unlike os.cpu_count)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def job_thread_budget():
+    """Encoder threads one job may use: FFMPEG_THREADS, or the cores shared out over this process's concurrent jobs"""
+    from app import app
+    
+    if app.config['FFMPEG_THREADS'] > 0:
+        return app.config['FFMPEG_THREADS']
+    concurrency = len(processing_threads) or app.config['CONCURRENT_PROCESSING']
+    return max(1, available_cpus() // max(1, concurrency))
+
+def rendition_threads(renditions, budget):
+    """Split a thread budget over the encoded renditions in proportion to their pixel counts
+    
+    Every rendition gets at least one thread, and the shares never add up to
+    more than the budget unless it is smaller than the number of renditions.
+    """
+    pixels = [rendition['width'] * rendition['height'] for rendition in renditions]
+    total = sum(pixels) or 1
+    spare = max(0, budget - len(renditions))
+    shares = [spare * count / total for count in pixels]
+    threads = [1 + int(share) for share in shares]
+    
+    # Threads left over after rounding down go to the largest remainders
+    leftover = spare - sum(int(share) for share in shares)
+    for index in sorted(range(len(shares)), key=lambda i: int(shares[i]) - shares[i])[:leftover]:
+        threads[index] += 1
+    return threads
+
+def rendition_video_args(rendition):
+    """libx264 arguments for one encoded rendition of the HLS ladder"""
+    video_bitrate = rendition['video_bitrate']
+    return [
+        '-c:v', 'libx264',  # Video codec
+        '-preset', 'medium',  # Compression preset
+        '-crf', '22',  # Quality (lower is better)
+        '-maxrate', f"{video_bitrate}k",  # Cap the bitrate so each rendition fits its ladder step
+        '-bufsize', f"{video_bitrate * 2}k",  # Rate control buffer
+        '-profile:v', 'main',  # H.264 profile playable by MP4 and HLS clients alike
+        '-level:v', f"{rendition['level'] // 10}.{rendition['level'] % 10}",  # Matches the CODECS attribute
+        '-pix_fmt', 'yuv420p',  # Widest decoder support
+        '-g', '48',  # Keyframe interval (lets HLS cut 4 second segments)
+        '-sc_threshold', '0',  # Disable scene change detection
+    ]
+
+def rendition_output_args(index, rendition, mp4_output, hls_dir):
+    """Muxer arguments for one rendition: the top one is teed into the MP4 as well, the rest are plain HLS"""
+    playlist_path = os.path.join(hls_dir, rendition['name'], 'playlist.m3u8')
+    
+    if index > 0:
+        args = []
+        for name, value in HLS_OPTIONS:
+            args += [f"-{name}", value]
+        return args + ['-f', 'hls', playlist_path]
+    
+    # The top rendition is also the downloadable MP4, the tee muxer fans its packets out to both
+    tee_outputs = '|'.join([
+        f"[f=mp4:movflags=+faststart]{tee_escape(mp4_output)}",
+        "[f=hls:" + ':'.join(f"{name}={value}" for name, value in HLS_OPTIONS) +
+        f"]{tee_escape(playlist_path)}",
+    ])
+    return [
+        '-flags', '+global_header',  # Needed by the MP4 side of the tee
+        '-f', 'tee',
+        tee_outputs
+    ]
+
+def scale_filter_graph(renditions, input_label='0:v:0'):
+    """Build a filter graph that decodes once and splits the picture into one scaled copy per rendition"""
+    labels = [f"v{index}" for index in range(len(renditions))]
+    filters = [f"[{input_label}]split={len(renditions)}" + ''.join(f"[{label}in]" for label in labels)]
+    for label, rendition in zip(labels, renditions):
+        scale = f"scale=-2:{rendition['height']}" if rendition['scale'] else 'null'
+        filters.append(f"[{label}in]{scale}[{label}]")
+    return ';'.join(filters)
+
+def verify_ladder_outputs(mp4_output, hls_dir, renditions):
+    """Check that the MP4 and every rendition playlist were written"""
+    outputs = [mp4_output] + [os.path.join(hls_dir, r['name'], 'playlist.m3u8') for r in renditions]
+    for output_path in outputs:
+        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+            logger.warning(f"Transcoded output not created or is empty: {output_path}")
+            return False
+    return True
+
+def transcode_to_mp4_and_hls(input_path, mp4_output, hls_dir, renditions, remux=False, duration=None, on_progress=None):
+    """Encode every HLS rendition in one ffmpeg run, tee the top one into the faststart MP4 and write master.m3u8"""
+    try:
+        master_path = os.path.join(hls_dir, 'master.m3u8')
+        logger.debug(f"Transcoding {input_path} to {mp4_output} and {master_path} "
+                     f"({', '.join(r['name'] for r in renditions)})")
+        
+        # Ensure the output directories exist
+        os.makedirs(os.path.dirname(mp4_output), exist_ok=True)
+        for rendition in renditions:
+            os.makedirs(os.path.join(hls_dir, rendition['name']), exist_ok=True)
+        
+        cmd = [
+            'ffmpeg',
+            '-y',  # Overwrite output files
+            '-i', input_path,  # Input file
+        ]
+        
+        # Decode once and split the picture into one scaled copy per encoded rendition
+        encoded = [rendition for rendition in renditions if not rendition['copy']]
+        if encoded:
+            cmd += ['-filter_complex', scale_filter_graph(encoded)]
+        threads = rendition_threads(encoded, job_thread_budget())
+        
+        for index, rendition in enumerate(renditions):
+            if rendition['copy']:
+                cmd += [
+                    '-map', '0:v:0',  # Source video stream
+                    '-map', '0:a:0?',  # First audio stream, if there is one
+                    '-c', 'copy',  # Stream copy, HLS segments are cut at the source keyframes
+                ]
+            else:
+                cmd += [
+                    '-map', f"[v{encoded.index(rendition)}]",  # Scaled video for this rendition
+                    '-map', '0:a:0?',  # First audio stream, if there is one
+                ] + rendition_video_args(rendition) + [
+                    '-threads', str(threads[encoded.index(rendition)]),  # This rendition's share of the job's CPU budget
+                    '-c:a', 'aac',  # Audio codec
+                    '-b:a', f"{rendition['audio_bitrate']}k",  # Audio bitrate
+                ]
+            cmd += rendition_output_args(index, rendition, mp4_output, hls_dir)
+        
+        logger.debug(f"Running command: {' '.join(cmd)}")
+        result = run_ffmpeg(cmd, duration, on_progress)
+        
+        if result.returncode != 0:
+            logger.warning(f"ffmpeg MP4/HLS ladder transcoding failed with error: {result.stderr}")
+            return False
+        
+        if not verify_ladder_outputs(mp4_output, hls_dir, renditions):
+            return False
+        
+        write_hls_master(hls_dir, renditions)
+        
+        logger.info(f"Transcoding successfully completed at {mp4_output} and {master_path}")
+        return True
+    
+    except subprocess.TimeoutExpired:
+        # Over the stage budget: let process_video retry the job, like JobCancelled escapes, rather than fall back
+        raise
+    except Exception as e:
+        logger.error(f"Error in transcode_to_mp4_and_hls: {e}")
+        return False
+
+def use_chunked_encoding(duration):
+    """Check whether a source is long enough to be split and encoded in parallel chunks"""
+    from app import app
+    
+    min_duration = app.config['CHUNKED_ENCODING_MIN_DURATION']
+    return min_duration > 0 and (duration or 0) >= min_duration
+
+def split_at_keyframes(input_path, work_dir, chunk_duration, duration=None):
+    """Stream-copy the source video into pieces of about `chunk_duration` seconds, cut at keyframes
+
+    Returns a list of (path, duration) tuples in playback order.
+    """
+    chunk_list = os.path.join(work_dir, 'chunks.csv')
+    cmd = [
+        'ffmpeg',
+        '-y',  # Overwrite output files
+        '-i', input_path,  # Input file
+        '-map', '0:v:0',  # Video only, audio is encoded once for the whole file
+        '-c', 'copy',  # No re-encoding, the segment muxer cuts at the next keyframe
+        '-f', 'segment',
+        '-segment_time', str(chunk_duration),  # Target piece length in seconds
+        '-segment_format', 'matroska',  # Holds any source codec
+        '-segment_list', chunk_list,  # CSV of filename,start,end per piece
+        '-segment_list_type', 'csv',
+        '-reset_timestamps', '1',  # Every piece starts at zero
+        os.path.join(work_dir, 'chunk%04d.mkv')
+    ]
+    
+    logger.debug(f"Running command: {' '.join(cmd)}")
+    result = run_process(cmd, 'split', duration)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg keyframe split error: {result.stderr}")
+    
+    chunks = []
+    with open(chunk_list) as f:
+        for line in f:
+            filename, start, end = line.strip().rsplit(',', 2)
+            chunks.append((os.path.join(work_dir, filename), float(end) - float(start)))
+    return chunks
+
+def concat_list_entry(path):
+    """Quote a path for an ffmpeg concat demuxer list"""
+    return "file '" + path.replace("'", "'\\''") + "'"
+
+def transcode_chunked(input_path, mp4_output, hls_dir, renditions, info, duration, on_progress=None):
+    """Encode a long source as keyframe-aligned chunks in parallel, then concatenate them into the MP4/HLS ladder
+
+    Every chunk is encoded into all renditions by its own ffmpeg process, at most
+    CHUNK_WORKERS at a time, and the audio is encoded once alongside them. The
+    encoded pieces are joined losslessly with the concat demuxer.
+    """
+    from app import app
+    
+    chunk_duration = app.config['CHUNK_DURATION']
+    budget = job_thread_budget()
+    # Each chunk process needs a thread per rendition, so by default only as many run as the budget can feed
+    workers = app.config['CHUNK_WORKERS'] or max(1, budget // len(renditions))
+    chunk_threads = rendition_threads(renditions, budget // workers)
+    has_audio = info.get('audio_codec') is not None
+    video_id = current_video_id()  # Pool threads run their ffmpeg processes under the same job
+    audio_bitrate = renditions[0]['audio_bitrate']
+    
+    os.makedirs(os.path.dirname(mp4_output), exist_ok=True)
+    for rendition in renditions:
+        os.makedirs(os.path.join(hls_dir, rendition['name']), exist_ok=True)
+    slug = os.path.splitext(os.path.basename(mp4_output))[0]
+    work_dir = tempfile.mkdtemp(prefix=f".chunks-{slug}-", dir=os.path.dirname(mp4_output))
+    
+    try:
+        chunks = split_at_keyframes(input_path, work_dir, chunk_duration, duration)
+        if not chunks:
+            raise Exception("Keyframe split produced no chunks")
+        logger.info(f"Encoding {input_path} as {len(chunks)} chunks with {workers} parallel ffmpeg processes")
+        
+        # Seconds of source encoded so far, per chunk
+        encoded_seconds = [0.0] * len(chunks)
+        progress_lock = threading.Lock()
+        
+        def encode_chunk(index, chunk_path, chunk_length):
+            def chunk_progress(percent, speed, eta_seconds, force=False):
+                with progress_lock:
+                    encoded_seconds[index] = chunk_length * percent / 100
+            
+            cmd = [
+                'ffmpeg',
+                '-y',  # Overwrite output files
+                '-i', chunk_path,  # Input chunk
+                '-filter_complex', scale_filter_graph(renditions),
+            ]
+            for rendition_index, rendition in enumerate(renditions):
+                cmd += ['-map', f"[v{rendition_index}]"] + rendition_video_args(rendition) + [
+                    '-threads', str(chunk_threads[rendition_index]),  # Parallelism comes from running chunks side by side
+                    os.path.join(work_dir, f"chunk{index:04d}_{rendition['name']}.mp4")
+                ]
+            
+            with job_scope(video_id):
+                result = run_ffmpeg(cmd, chunk_length, chunk_progress)
+            if result.returncode != 0:
+                raise Exception(f"ffmpeg chunk {index} encoding error: {result.stderr}")
+        
+        def encode_audio():
+            cmd = [
+                'ffmpeg',
+                '-y',  # Overwrite output files
+                '-i', input_path,  # Input file
+                '-map', '0:a:0',  # First audio stream
+                '-vn',  # No video
+                '-c:a', 'aac',  # Audio codec
+                '-b:a', f"{audio_bitrate}k",  # Audio bitrate
+                os.path.join(work_dir, 'audio.m4a')
+            ]
+            with job_scope(video_id):
+                result = run_process(cmd, 'audio', duration)
+            if result.returncode != 0:
+                raise Exception(f"ffmpeg audio encoding error: {result.stderr}")
+        
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = {pool.submit(encode_chunk, index, path, length) for index, (path, length) in enumerate(chunks)}
+            if has_audio:
+                pending.add(pool.submit(encode_audio))
+            
+            while pending:
+                done, pending = wait(pending, timeout=PROGRESS_UPDATE_INTERVAL, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    if future.exception():
+                        for other in pending:
+                            other.cancel()
+                        raise future.exception()
+                
+                # Report the combined progress of all chunks from this (the worker's) thread
+                if on_progress and duration:
+                    with progress_lock:
+                        done_seconds = sum(encoded_seconds)
+                    elapsed = time.monotonic() - started
+                    speed = done_seconds / elapsed if elapsed > 0 else None
+                    percent = max(0.0, min(99.0, done_seconds / duration * 100))
+                    eta_seconds = (duration - done_seconds) / speed if speed else None
+                    try:
+                        on_progress(round(percent, 1), speed, eta_seconds)
+                    except Exception as e:
+                        logger.warning(f"Failed to record chunked encode progress: {e}")
+        
+        # Join the pieces of each rendition and mux them with the audio into the MP4 and HLS outputs
+        cmd = ['ffmpeg', '-y']
+        for rendition in renditions:
+            list_path = os.path.join(work_dir, f"{rendition['name']}.txt")
+            with open(list_path, 'w') as f:
+                for index in range(len(chunks)):
+                    f.write(concat_list_entry(os.path.join(work_dir, f"chunk{index:04d}_{rendition['name']}.mp4")) + '\n')
+            cmd += ['-f', 'concat', '-safe', '0', '-i', list_path]
+        if has_audio:
+            cmd += ['-i', os.path.join(work_dir, 'audio.m4a')]
+        
+        for index, rendition in enumerate(renditions):
+            cmd += ['-map', f"{index}:v:0"]
+            if has_audio:
+                cmd += ['-map', f"{len(renditions)}:a:0"]
+            cmd += ['-c', 'copy'] + rendition_output_args(index, rendition, mp4_output, hls_dir)
+        
+        logger.debug(f"Running command: {' '.join(cmd)}")
+        result = run_process(cmd, 'concat', duration)
+        if result.returncode != 0:
+            raise Exception(f"ffmpeg chunk concatenation error: {result.stderr}")
+        
+        if not verify_ladder_outputs(mp4_output, hls_dir, renditions):
+            return False
+        
+        write_hls_master(hls_dir, renditions)
+        
+        logger.info(f"Chunked transcoding completed at {mp4_output} in {time.monotonic() - started:.1f}s")
+        return True
+    
+    except subprocess.TimeoutExpired:
+        raise
+    except Exception as e:
+        logger.error(f"Error in transcode_chunked: {e}")
+        return False
+    
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def measure_hls_bandwidth(playlist_path):
+    """Return the peak and average bitrate (bits/s) of the segments listed in a media playlist"""
+    playlist_dir = os.path.dirname(playlist_path)
+    peak = 0
+    total_bits = 0
+    total_duration = 0.0
+    segment_duration = None
+    
+    with open(playlist_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                segment_duration = float(line[len('#EXTINF:'):].split(',')[0])
+            elif line and not line.startswith('#') and segment_duration:
+                bits = os.path.getsize(os.path.join(playlist_dir, line)) * 8
+                peak = max(peak, bits / segment_duration)
+                total_bits += bits
+                total_duration += segment_duration
+                segment_duration = None
+    
+    average = total_bits / total_duration if total_duration else 0
+    return int(peak + 0.5), int(average + 0.5)
+
+def write_hls_master(hls_dir, renditions):
+    """Write master.m3u8 listing every rendition with its measured BANDWIDTH, RESOLUTION and CODECS"""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-INDEPENDENT-SEGMENTS']
+    
+    # Lowest rendition first so players that start with the first entry begin cheaply
+    for rendition in sorted(renditions, key=lambda r: (r['height'], r['video_bitrate'])):
+        playlist = f"{rendition['name']}/playlist.m3u8"
+        peak, average = measure_hls_bandwidth(os.path.join(hls_dir, playlist))
+        if not peak:
+            # Nothing to measure, advertise the nominal bitrate
+            peak = average = (rendition['video_bitrate'] + rendition['audio_bitrate']) * 1000
+        
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={peak},AVERAGE-BANDWIDTH={average},"
+                     f"RESOLUTION={rendition['width']}x{rendition['height']},"
+                     f"CODECS=\"{rendition['codecs']}\"")
+        lines.append(playlist)
+    
+    master_path = os.path.join(hls_dir, 'master.m3u8')
+    with open(master_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return master_path
+
+def transcode_to_mp4(input_path, output_path, duration=None, on_progress=None):
     """Transcode video to MP4 format with H.264 video and AAC audio"""
     try:
         logger.debug(f"Transcoding {input_path} to MP4 at {output_path}")
@@ -324,6 +1989,7 @@ def transcode_to_mp4(input_path, output_path):
             '-c:v', 'libx264',  # Video codec
             '-preset', 'medium',  # Compression preset
             '-crf', '22',  # Quality (lower is better)
+            '-threads', str(job_thread_budget()),  # Encoder threads for this job
             '-c:a', 'aac',  # Audio codec
             '-b:a', '128k',  # Audio bitrate
             '-movflags', '+faststart',  # Optimize for web streaming
@@ -333,7 +1999,7 @@ def transcode_to_mp4(input_path, output_path):
         logger.debug(f"Running command: {' '.join(cmd)}")
         
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            result = run_ffmpeg(cmd, duration, on_progress)
             
             # Check if FFmpeg succeeded
             if result.returncode != 0:
@@ -348,6 +2014,9 @@ def transcode_to_mp4(input_path, output_path):
             logger.info(f"Transcoding successfully completed at {output_path}")
             return True
             
+        except subprocess.TimeoutExpired:
+            # The copy fallback is for ffmpeg errors, not for a hung ffmpeg
+            raise
         except Exception as ffmpeg_error:
             # FFmpeg failed - use fallback method
             logger.warning(f"Transcoding failed, using fallback: {ffmpeg_error}")
@@ -364,12 +2033,19 @@ def transcode_to_mp4(input_path, output_path):
                 logger.error(f"Fallback copy also failed for {input_path}")
                 return False
     
+    except subprocess.TimeoutExpired:
+        raise
     except Exception as e:
         logger.error(f"Error in transcode_to_mp4: {e}")
         return False
 
-def create_hls_stream(input_path, output_dir):
-    """Create HLS stream for adaptive bitrate streaming"""
+def create_hls_stream(input_path, output_dir, duration=None, on_progress=None, mp4_ref=None):
+    """Create HLS stream for adaptive bitrate streaming
+    
+    `mp4_ref` is how the fallback playlist refers to the MP4; it defaults to
+    the path relative to output_dir, which is wrong when both are published
+    somewhere else afterwards.
+    """
     try:
         playlist_path = os.path.join(output_dir, 'playlist.m3u8')
         logger.debug(f"Creating HLS stream from {input_path} to {playlist_path}")
@@ -391,6 +2067,7 @@ def create_hls_stream(input_path, output_dir):
             '-g', '48',  # Keyframe interval (reduced for more stable playback)
             '-sc_threshold', '0',  # Disable scene change detection
             '-c:v', 'libx264',  # Video codec
+            '-threads', str(job_thread_budget()),  # Encoder threads for this job
             '-c:a', 'aac',  # Audio codec
             '-b:a', '128k',  # Audio bitrate
             '-f', 'hls',  # Format
@@ -399,7 +2076,7 @@ def create_hls_stream(input_path, output_dir):
         
         try:
             logger.debug(f"Running command: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            result = run_ffmpeg(cmd, duration, on_progress)
             
             if result.returncode != 0:
                 logger.warning(f"ffmpeg HLS creation returned error: {result.stderr}")
@@ -413,14 +2090,17 @@ def create_hls_stream(input_path, output_dir):
             logger.info(f"HLS stream successfully created at {playlist_path}")
             return True
             
+        except subprocess.TimeoutExpired:
+            # Likewise the single-file playlist fallback
+            raise
         except Exception as ffmpeg_error:
             # Create a simple playlist that just points to the MP4 file
             logger.warning(f"HLS creation failed with FFmpeg: {ffmpeg_error}")
             logger.info(f"FALLBACK: Creating a simple HLS playlist for {input_path}")
             
             # Get relative path to the mp4 file from the HLS directory
-            # Typically will be something like "../processed/slug.mp4"
-            rel_path = os.path.relpath(input_path, output_dir)
+            # Typically will be something like "../../processed/slug.mp4"
+            rel_path = mp4_ref or os.path.relpath(input_path, output_dir)
             
             # Create a very simple HLS playlist that just references the original MP4
             # This won't support adaptive streaming but will allow playback
@@ -442,6 +2122,8 @@ def create_hls_stream(input_path, output_dir):
                 logger.error(f"Failed to create fallback HLS playlist: {fallback_error}")
                 return False
     
+    except subprocess.TimeoutExpired:
+        raise
     except Exception as e:
         logger.error(f"Error in create_hls_stream: {e}")
         return False
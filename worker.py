@@ -0,0 +1,55 @@
+import os
+import sys
+import signal
+import logging
+import argparse
+import threading
+
+# This process runs its own worker pool, don't let importing the app start the default one
+os.environ["PROCESSOR_ENABLED"] = "false"
+
+from app import app  # noqa: E402
+import video_processor  # noqa: E402
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def run_worker(concurrency, download_concurrency, shutdown_timeout):
+    """Drain the processing queue until SIGTERM/SIGINT, then stop gracefully"""
+    shutdown = threading.Event()
+    
+    def request_shutdown(signum, frame):
+        logger.info(f"Received {signal.Signals(signum).name}, shutting down")
+        shutdown.set()
+    
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    
+    with app.app_context():
+        video_processor.init_processor(concurrency, download_concurrency)
+    
+    while not shutdown.is_set():
+        shutdown.wait(1)
+    
+    # Let running jobs finish; past the timeout hand them back to the queue for another worker
+    if not video_processor.stop_processor(shutdown_timeout):
+        requeued = video_processor.requeue_running_jobs()
+        logger.warning(f"Shutdown timeout reached, requeued {requeued} running job(s)")
+        return video_processor.stop_processor(30)
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a video processing worker without the web app")
+    parser.add_argument("--concurrency", type=int, default=app.config["CONCURRENT_PROCESSING"],
+                        help="Videos processed at once (default: CONCURRENT_PROCESSING)")
+    parser.add_argument("--download-concurrency", type=int, default=app.config["DOWNLOAD_CONCURRENCY"],
+                        help="Link downloads run at once, 0 to leave downloads to other workers (default: DOWNLOAD_CONCURRENCY)")
+    parser.add_argument("--shutdown-timeout", type=float, default=60,
+                        help="Seconds to wait for running jobs on shutdown before requeueing them (default: 60)")
+    args = parser.parse_args()
+    
+    return 0 if run_worker(args.concurrency, args.download_concurrency, args.shutdown_timeout) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())